@@ -0,0 +1,25 @@
+# aural_alchemy  Aural Alchemy engine package (no Streamlit)
+# `import aural_alchemy` is cheap: the engine (and numpy) load on first
+# attribute access, e.g. aural_alchemy.generate_progressions.
+
+_ENGINE_EXPORTS = (
+    "BAN_MODES",
+    "VOICING_OPTIMIZERS",
+    "SAMPLER_MODES",
+    "BanIndex",
+    "generate_progressions",
+    "load_banlist_cached",
+    "load_banlist_from_stream",
+    "build_pack",
+    "build_pack_bytes",
+    "write_pack",
+)
+
+__all__ = list(_ENGINE_EXPORTS)
+
+
+def __getattr__(name: str):
+    if name in _ENGINE_EXPORTS:
+        from . import engine
+        return getattr(engine, name)
+    raise AttributeError(f"module 'aural_alchemy' has no attribute '{name}'")
@@ -0,0 +1,256 @@
+# aural_alchemy/bench.py  Aural Alchemy | engine benchmarks
+# python -m aural_alchemy.bench -o bench.json              # run and save
+# python -m aural_alchemy.bench --compare baseline.json    # run, flag regressions
+# python -m aural_alchemy.bench --quick                    # skip n=20,000
+# Every case uses fixed seeds and resets the engine's process caches
+# (chord library, register locks) first, so two runs of the same tree on the
+# same machine time the same work. Results are best-of-N milliseconds.
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+from . import engine
+
+BENCH_VERSION = 1
+BENCH_SEED = 1234
+GENERATE_SIZES = (10, 200, 2_000, 20_000)
+QUICK_MAX_N = 2_000
+BENCH_BALANCES = {
+    "default": None,
+    "sus_max": dict({q: 50 for q in engine.ADV_ALL_QUALITIES}, sus2=100, sus4=100, sus2add9=100, sus4add9=100),
+    "triads_off": dict({q: 100 for q in engine.ADV_ALL_QUALITIES}, maj=0, min=0, sus2=0, sus4=0),
+}
+VOICING_PROGRESSIONS = 40
+BANLIST_BENCH_LINES = 50_000
+REGRESSION_TOLERANCE = 0.20      # flag a case more than 20% slower than its baseline
+CASE_BUDGET_MS = 1_000.0         # keep repeating a case until this much time is spent...
+CASE_MAX_RUNS = 25               # ...or this many runs; best-of-N absorbs scheduler noise
+
+
+def _reset_caches():
+    engine.chord_cache_clear()
+    engine._register_lock.cache_clear()
+    engine._register_shifts.cache_clear()
+
+
+def _timed(fn: Callable[[], object], min_runs: int = 3) -> Dict[str, float]:
+    """Best and median milliseconds (caches reset before each call)."""
+    runs = []
+    while len(runs) < min_runs or (sum(runs) < CASE_BUDGET_MS and len(runs) < CASE_MAX_RUNS):
+        _reset_caches()
+        t0 = time.perf_counter()
+        fn()
+        runs.append((time.perf_counter() - t0) * 1000.0)
+    return {"ms": min(runs), "median_ms": statistics.median(runs), "runs": len(runs)}
+
+
+def _bench_progressions(n: int) -> list:
+    return engine.generate_progressions(n, BENCH_SEED)[0]
+
+
+# ---------------------------------------------------------
+# Cases: each returns {case name: {"ms": ..., extra fields}}
+# ---------------------------------------------------------
+def bench_generate(sizes=GENERATE_SIZES, balances=BENCH_BALANCES) -> Dict[str, dict]:
+    out = {}
+    for name, balance in balances.items():
+        engine.get_generation_plan(balance)   # compiled once per process in the app too
+        for n in sizes:
+            case = f"generate/n={n}/{name}"
+            try:
+                res = _timed(lambda: engine.generate_progressions(n, BENCH_SEED, chord_balance=balance), 3 if n <= QUICK_MAX_N else 1)
+            except RuntimeError as e:
+                out[case] = {"error": str(e)}
+                continue
+            res["us_per_progression"] = res["ms"] * 1000.0 / n
+            out[case] = res
+    return out
+
+
+def bench_voicing(progressions: list) -> Dict[str, dict]:
+    out = {}
+    chords = [(ch, key) for prog, _, key in progressions for ch in prog]
+    saved = engine.VOICING_MODE
+    try:
+        for mode in engine.VOICING_PROFILES:
+            engine.VOICING_MODE = mode
+            out[f"build_voicing_table/{mode}"] = _timed(lambda: engine.build_voicing_table(mode), 1)
+            engine.get_voicing_table(mode)
+
+            def run():
+                rng = random.Random(BENCH_SEED)
+                prev_v, prev_name = None, ""
+                for name, key in chords:
+                    raw = engine.raw_chord_notes(name)
+                    prev_v = engine.choose_best_voicing(prev_v, prev_name or name, name, raw, key, rng)
+                    prev_name = name
+
+            res = _timed(run)
+            res["us_per_chord"] = res["ms"] * 1000.0 / len(chords)
+            out[f"choose_best_voicing/{mode}"] = res
+    finally:
+        engine.VOICING_MODE = saved
+    return out
+
+
+def bench_register(progressions: list) -> Dict[str, dict]:
+    raws = [[engine.raw_chord_notes(ch) for ch in prog] for prog, _, _ in progressions]
+
+    def run():
+        for raw in raws:
+            engine.optimize_progression_register(raw)
+
+    res = _timed(run)
+    res["us_per_progression"] = res["ms"] * 1000.0 / len(raws)
+    return {"optimize_progression_register": res}
+
+
+def _banlist_text(lines: int) -> bytes:
+    rng = random.Random(BENCH_SEED)
+    names = [engine.chord_name(cid, "C") for cid in range(engine.N_CHORD_IDS)]
+    out = []
+    for i in range(lines):
+        if i % 50 == 0:
+            out.append(f"PACK {i // 50 + 1} - 8 BARS")
+        out.append(" - ".join(rng.choice(names) for _ in range(rng.randint(2, 6))))
+    return ("\n".join(out) + "\n").encode("utf-8")
+
+
+def bench_banlist(lines: int = BANLIST_BENCH_LINES) -> Dict[str, dict]:
+    data = _banlist_text(lines)
+    res = _timed(lambda: engine.load_banlist_from_txt_bytes(data))
+    res["mb"] = len(data) / 1e6
+    res["mb_per_s"] = res["mb"] / (res["ms"] / 1000.0)
+    return {"load_banlist_from_txt_bytes": res}
+
+
+def bench_pack(progressions: list) -> Dict[str, dict]:
+    out = {}
+    saved = engine.CHORD_CACHE_DIR
+    engine.CHORD_CACHE_DIR = ""   # a warm disk cache would hide render time
+    try:
+        for revoice in (False, True):
+            engine.get_voicing_table(engine.VOICING_MODE)
+
+            def run():
+                zip_path, _, _ = engine.build_pack(progressions, revoice=revoice, seed=BENCH_SEED)
+                shutil.rmtree(os.path.dirname(zip_path), ignore_errors=True)
+
+            out[f"build_pack/revoice={revoice}"] = _timed(run)
+    finally:
+        engine.CHORD_CACHE_DIR = saved
+    return out
+
+
+def run_suite(quick: bool = False, log=None) -> dict:
+    sizes = tuple(n for n in GENERATE_SIZES if not quick or n <= QUICK_MAX_N)
+    progressions = _bench_progressions(VOICING_PROGRESSIONS)
+    results: Dict[str, dict] = {}
+    for label, fn in (
+        ("generate", lambda: bench_generate(sizes)),
+        ("voicing", lambda: bench_voicing(progressions)),
+        ("register", lambda: bench_register(progressions)),
+        ("banlist", bench_banlist),
+        ("pack", lambda: bench_pack(progressions)),
+    ):
+        if log is not None:
+            log(f"running {label}…")
+        results.update(fn())
+    return {
+        "version": BENCH_VERSION,
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "quick": quick,
+        },
+        "results": results,
+    }
+
+
+# ---------------------------------------------------------
+# Comparison
+# ---------------------------------------------------------
+def compare(current: dict, baseline: dict, tolerance: float = REGRESSION_TOLERANCE) -> List[dict]:
+    """One row per case in both runs; status is ok / faster / REGRESSION / error."""
+    rows = []
+    base = baseline.get("results", {})
+    for case, res in current["results"].items():
+        if case not in base:
+            continue
+        old = base[case]
+        if "error" in res or "error" in old:
+            status = "ok" if ("error" in res) == ("error" in old) else "error"
+            rows.append({"case": case, "base_ms": old.get("ms"), "ms": res.get("ms"), "ratio": None, "status": status})
+            continue
+        ratio = res["ms"] / old["ms"] if old["ms"] > 0 else float("inf")
+        if ratio > 1.0 + tolerance:
+            status = "REGRESSION"
+        elif ratio < 1.0 / (1.0 + tolerance):
+            status = "faster"
+        else:
+            status = "ok"
+        rows.append({"case": case, "base_ms": old["ms"], "ms": res["ms"], "ratio": ratio, "status": status})
+    return rows
+
+
+def _format_ms(ms: Optional[float]) -> str:
+    return "-" if ms is None else f"{ms:,.2f}"
+
+
+def _print_results(report: dict):
+    for case, res in report["results"].items():
+        if "error" in res:
+            print(f"{case:<48} error: {res['error']}")
+            continue
+        extra = ", ".join(f"{k}={v:,.2f}" for k, v in res.items() if k not in ("ms", "median_ms", "runs"))
+        print(f"{case:<48} {_format_ms(res['ms']):>12} ms  {extra}")
+
+
+def _print_comparison(rows: List[dict]):
+    print(f"{'case':<48} {'baseline':>12} {'current':>12} {'ratio':>7}  status")
+    for r in rows:
+        ratio = "-" if r["ratio"] is None else f"{r['ratio']:.2f}x"
+        print(f"{r['case']:<48} {_format_ms(r['base_ms']):>12} {_format_ms(r['ms']):>12} {ratio:>7}  {r['status']}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    p = argparse.ArgumentParser(prog="python -m aural_alchemy.bench", description="Benchmark the Aural Alchemy engine.")
+    p.add_argument("-o", "--out", default=None, help="write results as JSON")
+    p.add_argument("--compare", default=None, help="baseline JSON; exit 1 if any case regressed")
+    p.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                   help=f"allowed slowdown before a case is flagged (default {REGRESSION_TOLERANCE:.2f})")
+    p.add_argument("--quick", action="store_true", help=f"skip generate sizes above {QUICK_MAX_N:,}")
+    args = p.parse_args(argv)
+
+    report = run_suite(quick=args.quick, log=lambda msg: print(msg, file=sys.stderr))
+    _print_results(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare(report, baseline, args.tolerance)
+        print()
+        _print_comparison(rows)
+        if any(r["status"] in ("REGRESSION", "error") for r in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# aural_alchemy/cli.py  Aural Alchemy | batch pack builder
+# python -m aural_alchemy -n 50 --seed 7 --balance maj9=80,sus4=0 \
+#     --banlist bans.txt --revoice --profile wide -o pack.zip
+# The engine is imported after argument parsing, so --help and bad flags
+# return immediately.
+
+import argparse
+import contextlib
+import os
+import random
+import sys
+from typing import Dict, List, Optional, Tuple
+
+
+def _parse_balance(text: str) -> Dict[str, int]:
+    """"maj9=80,sus4=0" -> {"maj9": 80, "sus4": 0}; unlisted qualities stay at the default."""
+    out = {}
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        qual, sep, value = part.partition("=")
+        if not sep or not value.strip().lstrip("-").isdigit():
+            raise argparse.ArgumentTypeError(f"expected QUALITY=0..100, got '{part}'")
+        out[qual.strip()] = max(0, min(100, int(value)))
+    return out
+
+
+def _print_stats(report: dict):
+    attempts, accepted = report["attempts"], report["accepted"]
+    rate = accepted / attempts * 100.0 if attempts else 0.0
+    print(f"Attempts: {attempts:,}, accepted: {accepted:,} ({rate:.2f}%)", file=sys.stderr)
+    for reason, count in report["rejections"].items():
+        print(f"  rejected {reason:<18} {count:>10,}", file=sys.stderr)
+    for stage, ms in report["stage_ms"].items():
+        print(f"  {stage:<27} {ms:>10,.1f} ms", file=sys.stderr)
+
+
+def _print_progression(i: int, item: tuple):
+    chords, durs, key = item
+    print(f"{i:>4}  {key:<3} {int(sum(durs)):>2} bars  {' - '.join(chords)}")
+
+
+def _check_stream(stream, budget):
+    if budget is not None and budget.summary():
+        print(budget.summary(), file=sys.stderr)
+    if stream.low_sim_total != 0:
+        raise RuntimeError("Safety check failed: low-sim transitions detected.")
+
+
+@contextlib.contextmanager
+def _part_file(out: str):
+    """Opens OUT.part for writing; renamed to OUT when the block completes, removed if it fails."""
+    part = f"{out}.part"
+    try:
+        with open(part, "wb") as f:
+            yield f
+        os.replace(part, out)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+
+def _write_streamed(engine, stream, args, seed: int, gen_stats, budget) -> Tuple[str, int, int]:
+    """
+    Renders each progression into the ZIP as it is generated, so memory stays
+    flat for any --count. Writes to OUT.part and renames it when complete.
+    Returns (path, progression count, chord count).
+    """
+    out = args.out or engine._pack_zip_name(args.revoice)
+    with _part_file(out) as f:
+        writer = engine.PackWriter(f, revoice=args.revoice, seed=seed, optimizer=args.optimizer, stats=gen_stats)
+        try:
+            for item in stream:
+                writer.add(item)
+                if args.list:
+                    _print_progression(writer.count, item)
+            _check_stream(stream, budget)
+        except BaseException:
+            writer.discard()
+            raise
+        chord_count = writer.close()
+    return out, writer.count, chord_count
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(
+        prog="python -m aural_alchemy",
+        description="Generate ambient chord progressions and write them as a MIDI pack (.zip).",
+    )
+    p.add_argument("-n", "--count", type=int, default=10, help="progressions to generate (default 10)")
+    p.add_argument("--seed", type=int, default=None, help="seed for a reproducible pack (default: random)")
+    p.add_argument("--balance", type=_parse_balance, default=None,
+                   help="chord type balance, e.g. maj9=80,min11=100,sus4=0 (0 disables, 50 is default)")
+    p.add_argument("--banlist", default=None, help=".txt banlist, one progression per line")
+    p.add_argument("--ban-mode", default="exact",
+                   help="exact | rotation | contains | transposed (default exact)")
+    p.add_argument("--revoice", action="store_true", help="re-voice chords with the voicing engine")
+    p.add_argument("--profile", default="default", help="voicing profile: default | wide | low")
+    p.add_argument("--optimizer", default="greedy", help="re-voicing optimizer: greedy | viterbi")
+    p.add_argument("--sampler", default="rejection", help="rejection | exact")
+    p.add_argument("--workers", type=int, default=0,
+                   help="generation processes (0 keeps the legacy single-stream output per seed)")
+    p.add_argument("--deadline", type=float, default=None,
+                   help="generation time budget in seconds; relaxes rules / returns fewer instead of running on "
+                        "(the result then depends on machine speed)")
+    p.add_argument("--max-attempts", type=int, default=None,
+                   help="generation attempt budget (deterministic alternative to --deadline)")
+    p.add_argument("--relax", default="pattern_dupes,sus_safety,fewer",
+                   help="relaxation ladder used with a budget, in order (default pattern_dupes,sus_safety,fewer; 'none' to fail instead)")
+    p.add_argument("--render-workers", type=int, default=0, help="rendering processes (0 = in-process)")
+    p.add_argument("-o", "--out", default=None, help="output .zip path (default: the app's download name)")
+    p.add_argument("--list", action="store_true", help="print the progressions")
+    p.add_argument("--stats", action="store_true",
+                   help="print attempts, rejection reasons and per-stage timings to stderr")
+    return p
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.count < 1:
+        parser.error("--count must be at least 1")
+
+    from . import engine
+
+    for value, options, flag in (
+        (args.ban_mode, engine.BAN_MODES, "--ban-mode"),
+        (args.profile, engine.VOICING_PROFILES, "--profile"),
+        (args.optimizer, engine.VOICING_OPTIMIZERS, "--optimizer"),
+        (args.sampler, engine.SAMPLER_MODES, "--sampler"),
+    ):
+        if value not in options:
+            parser.error(f"{flag} must be one of: {', '.join(options)}")
+    ladder = tuple(r.strip() for r in args.relax.split(",") if r.strip() and r.strip() != "none")
+    bad = [r for r in ladder if r not in engine.RELAXATION_LADDER]
+    if bad:
+        parser.error(f"--relax rungs must be from: {', '.join(engine.RELAXATION_LADDER)}")
+    if args.balance:
+        unknown = sorted(set(args.balance) - set(engine.ADV_ALL_QUALITIES))
+        if unknown:
+            parser.error(f"unknown chord qualities in --balance: {', '.join(unknown)}")
+
+    # the one place the renderer reads its profile from
+    engine.VOICING_MODE = args.profile
+    seed = args.seed if args.seed is not None else random.randint(1, 2_000_000_000)
+
+    ban_set = engine.BanIndex()
+    if args.banlist:
+        try:
+            with open(args.banlist, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            parser.error(f"cannot read banlist: {e}")
+        ban_set, stats, _ = engine.load_banlist_cached(data)
+        print(
+            f"Banlist: {stats['added']} added, {stats['invalid']} invalid ({stats['source']}, {stats['load_ms']:.0f} ms)",
+            file=sys.stderr,
+        )
+    ban_set = ban_set.with_mode(args.ban_mode)
+
+    gen_stats = engine.GenerationStats() if args.stats else None
+    budget = None
+    if args.deadline is not None or args.max_attempts is not None:
+        budget = engine.GenerationBudget(deadline_s=args.deadline, max_attempts=args.max_attempts, ladder=ladder)
+    stream = engine.iter_progressions(
+        n=args.count,
+        seed=seed,
+        chord_balance=args.balance,
+        ban_set=ban_set,
+        sampler=args.sampler,
+        workers=args.workers,
+        stats=gen_stats,
+        budget=budget,
+    )
+    try:
+        if args.render_workers > 1:
+            # pooled rendering needs the whole list up front
+            progressions = list(stream)
+            _check_stream(stream, budget)
+            out = args.out or engine._pack_zip_name(args.revoice)
+            with _part_file(out) as f:
+                chord_count, _ = engine.write_pack(
+                    f, progressions, revoice=args.revoice, seed=seed,
+                    workers=args.render_workers, optimizer=args.optimizer, stats=gen_stats,
+                )
+            if args.list:
+                for i, item in enumerate(progressions, start=1):
+                    _print_progression(i, item)
+            count = len(progressions)
+        else:
+            out, count, chord_count = _write_streamed(engine, stream, args, seed, gen_stats, budget)
+    except (RuntimeError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if gen_stats is not None:
+            _print_stats(gen_stats.as_dict())
+
+    print(f"Wrote {out}: {count} progressions, {chord_count} chords (seed {seed})", file=sys.stderr)
+    return 0
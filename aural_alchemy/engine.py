@@ -0,0 +1,3919 @@
+# aural_alchemy/engine.py  Aural Alchemy | progression + MIDI engine (headless)
+# Everything app.py and the CLI (python -m aural_alchemy) share, with no Streamlit:
+# - Theory tables + chord IDs
+# - Banlist extractor, packed index and content-hash cache
+# - Progression generator (rejection / exact samplers, worker pools)
+# - Voicing engine (register lock, octave optimizer, Viterbi voice leading)
+# - MIDI writers, chord library cache and pack builders (disk + memory)
+# pretty_midi is only imported when the fallback exporter runs.
+
+import io
+import os
+import re
+import math
+import random
+import bisect
+import tempfile
+import hashlib
+import time
+import threading
+import json
+import shutil
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from zipfile import ZipFile
+from collections import Counter, OrderedDict
+from functools import lru_cache
+from itertools import accumulate
+from typing import Container, List, Optional, Dict, Tuple
+
+import numpy as np
+
+
+# =========================================================
+# FEATURE FLAGS (DEV ONLY)
+# =========================================================
+ENABLE_CHORD_BALANCE_FEATURE = True
+
+
+# =========================================================
+# MUSICAL DATA + SAFE CHORD DEFINITIONS
+# =========================================================
+NOTE_TO_PC = {
+    "C": 0, "B#": 0, "C#": 1, "Db": 1, "D": 2, "D#": 3, "Eb": 3, "E": 4, "Fb": 4, "E#": 5, "F": 5,
+    "F#": 6, "Gb": 6, "G": 7, "G#": 8, "Ab": 8, "A": 9, "A#": 10, "Bb": 10, "B": 11, "Cb": 11,
+}
+
+KEYS = ["C", "Db", "D", "Eb", "E", "F", "Gb", "G", "Ab", "A", "Bb", "B"]
+
+SCALES = {
+    "C":  ["C","D","E","F","G","A","B"],
+    "Db": ["Db","Eb","F","Gb","Ab","Bb","C"],
+    "D":  ["D","E","F#","G","A","B","C#"],
+    "Eb": ["Eb","F","G","Ab","Bb","C","D"],
+    "E":  ["E","F#","G#","A","B","C#","D#"],
+    "F":  ["F","G","A","Bb","C","D","E"],
+    "Gb": ["Gb","Ab","Bb","Cb","Db","Eb","F"],
+    "G":  ["G","A","B","C","D","E","F#"],
+    "Ab": ["Ab","Bb","C","Db","Eb","F","G"],
+    "A":  ["A","B","C#","D","E","F#","G#"],
+    "Bb": ["Bb","C","D","Eb","F","G","A"],
+    "B":  ["B","C#","D#","E","F#","G#","A#"],
+}
+
+QUAL_TO_INTERVALS = {
+    "maj":        [0,4,7],
+    "min":        [0,3,7],
+
+    "maj7":       [0,4,7,11],
+    "maj9":       [0,4,7,11,14],
+    "add9":       [0,4,7,14],
+    "6":          [0,4,7,9],
+    "6add9":      [0,4,7,9,14],
+
+    "min7":       [0,3,7,10],
+    "min9":       [0,3,7,10,14],
+    "min11":      [0,3,7,10,14,17],
+
+    "sus2":       [0,2,7],
+    "sus4":       [0,5,7],
+    "sus2add9":   [0,2,7,14],
+    "sus4add9":   [0,5,7,14],
+}
+QUALITY_NOTECOUNT = {q: len(v) for q, v in QUAL_TO_INTERVALS.items()}
+
+
+def _pc(note: str) -> int:
+    return NOTE_TO_PC[note]
+
+
+# ---------------------------------------------------------
+# THEORY INDEX (built once at import)
+# 12-bit pitch-class masks: bit i set <=> pitch class i is present.
+# Shared tones between two chords = popcount(mask_a & mask_b).
+# ---------------------------------------------------------
+def _pcs_to_mask(pcs) -> int:
+    m = 0
+    for p in pcs:
+        m |= 1 << (int(p) % 12)
+    return m
+
+
+# (root_pc, quality) -> chord mask
+CHORD_PC_MASK: Dict[Tuple[int, str], int] = {
+    (r, q): _pcs_to_mask(r + iv for iv in ivs)
+    for r in range(12)
+    for q, ivs in QUAL_TO_INTERVALS.items()
+}
+
+# key -> scale mask
+KEY_PC_MASK: Dict[str, int] = {k: _pcs_to_mask(_pc(n) for n in SCALES[k]) for k in KEYS}
+
+# (key, degree) -> qualities that stay inside the scale (QUAL_TO_INTERVALS order)
+DIATONIC_QUALS: Dict[Tuple[str, int], List[str]] = {
+    (k, deg): [
+        q for q in QUAL_TO_INTERVALS
+        if not (CHORD_PC_MASK[(_pc(SCALES[k][deg]), q)] & ~KEY_PC_MASK[k])
+    ]
+    for k in KEYS
+    for deg in range(7)
+}
+
+
+# ---------------------------------------------------------
+# Chord IDs: one byte per chord, root_pc * len(QUALITY_ORDER) + quality
+# index (12 x 14 = 168). Progressions travel as bytes of IDs; names are
+# spelled from the key only for filenames and the UI table.
+# ---------------------------------------------------------
+QUALITY_ORDER: Tuple[str, ...] = tuple(QUAL_TO_INTERVALS)
+QUALITY_INDEX: Dict[str, int] = {q: i for i, q in enumerate(QUALITY_ORDER)}
+N_CHORD_IDS = 12 * len(QUALITY_ORDER)
+
+CHORD_ID_ROOT_PC: Tuple[int, ...] = tuple(cid // len(QUALITY_ORDER) for cid in range(N_CHORD_IDS))
+CHORD_ID_QUAL: Tuple[str, ...] = tuple(QUALITY_ORDER[cid % len(QUALITY_ORDER)] for cid in range(N_CHORD_IDS))
+
+# every root spelling x quality -> ID (enharmonic spellings share an ID)
+CHORD_ID_BY_NAME: Dict[str, int] = {
+    root + q: pc * len(QUALITY_ORDER) + i
+    for root, pc in NOTE_TO_PC.items()
+    for i, q in enumerate(QUALITY_ORDER)
+}
+
+# key -> {root_pc: spelling used by that key}; off-scale roots use KEYS spelling
+KEY_SPELLING: Dict[str, Dict[int, str]] = {k: {_pc(n): n for n in SCALES[k]} for k in KEYS}
+
+# key -> degree -> root_pc
+KEY_DEGREE_PC: Dict[str, Tuple[int, ...]] = {k: tuple(_pc(n) for n in SCALES[k]) for k in KEYS}
+
+
+def chord_id(root_pc: int, qual: str) -> int:
+    return (root_pc % 12) * len(QUALITY_ORDER) + QUALITY_INDEX[qual]
+
+
+def chord_ids(chords) -> Optional[bytes]:
+    """Chord names -> ID bytes, or None when a name is outside the vocabulary (e.g. slash chords)."""
+    out = bytearray()
+    for ch in chords:
+        cid = CHORD_ID_BY_NAME.get(ch)
+        if cid is None:
+            return None
+        out.append(cid)
+    return bytes(out)
+
+
+def chord_name(cid: int, key: Optional[str] = None) -> str:
+    pc = CHORD_ID_ROOT_PC[cid]
+    root = KEY_SPELLING[key].get(pc, KEYS[pc]) if key else KEYS[pc]
+    return root + CHORD_ID_QUAL[cid]
+
+
+def chord_names(ids: bytes, key: Optional[str] = None) -> List[str]:
+    return [chord_name(cid, key) for cid in ids]
+
+
+def _chord_pc_mask(root_note: str, qual: str) -> int:
+    return CHORD_PC_MASK[(NOTE_TO_PC[root_note], qual)]
+
+
+def _shared_tones(mask_a: int, mask_b: int) -> int:
+    return (mask_a & mask_b).bit_count()
+
+
+def _is_diatonic_chord(key: str, root_note: str, qual: str) -> bool:
+    return not (_chord_pc_mask(root_note, qual) & ~KEY_PC_MASK[key])
+
+
+def _shared_tone_ok_loop(roots, quals, need=1, loop=True) -> bool:
+    masks = [_chord_pc_mask(r, q) for r, q in zip(roots, quals)]
+    for a, b in zip(masks, masks[1:]):
+        if _shared_tones(a, b) < need:
+            return False
+    if loop and len(masks) >= 2:
+        if _shared_tones(masks[-1], masks[0]) < need:
+            return False
+    return True
+
+
+def _low_sim_count_loop(roots, quals, loop=True) -> int:
+    masks = [_chord_pc_mask(r, q) for r, q in zip(roots, quals)]
+    bad = 0
+    for a, b in zip(masks, masks[1:]):
+        if not (a & b):
+            bad += 1
+    if loop and len(masks) >= 2 and not (masks[-1] & masks[0]):
+        bad += 1
+    return bad
+
+
+class WeightedTable:
+    """
+    Prefix-sum weights built once; draw() is a single bisect.
+    Consumes the RNG exactly like rng.choices(items, weights=ws, k=1)[0],
+    so seeded output is unchanged.
+    """
+    __slots__ = ("items", "cum", "total", "hi")
+
+    def __init__(self, items_with_w):
+        self.items = [x for x, _ in items_with_w]
+        self.cum = list(accumulate(w for _, w in items_with_w))
+        self.total = (self.cum[-1] + 0.0) if self.cum else 0.0
+        self.hi = len(self.items) - 1
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def draw(self, rng: random.Random):
+        if not self.items:
+            return None
+        return self.items[bisect.bisect(self.cum, rng.random() * self.total, 0, self.hi)]
+
+
+# =========================================================
+# BANLIST (TXT UPLOAD) - SMART EXTRACTOR + ordered matching
+# Extracts chord progressions from messy txt (headers, notes, bullets)
+# Start matters (ordered match) by default
+# =========================================================
+# exact: same chords, same start | rotation: any rotation of a banned loop |
+# contains: a banned fragment anywhere in the loop (including across the wrap) |
+# transposed: the same root motion and qualities in any of the 12 keys
+BAN_MODES = ("exact", "rotation", "contains", "transposed")
+BAN_MODE_LABELS = {
+    "exact": "Exact (start matters)",
+    "rotation": "Any Rotation",
+    "contains": "Contains Fragment",
+    "transposed": "Any Key",
+}
+
+
+def _norm_dash(s: str) -> str:
+    # Normalize different dash chars to "-"
+    return (s or "").replace("–", "-").replace("—", "-").replace("−", "-")
+
+
+def _normalize_quality(q: str) -> str:
+    q = (q or "").strip().replace(" ", "")
+    q = q.replace("6/9", "6add9").replace("6\\9", "6add9")
+    q_low = q.lower()
+
+    # maj6 -> 6
+    if q_low in ("maj6", "ma6"):
+        return "6"
+
+    # keep maj* as-is
+    if q_low.startswith("maj"):
+        return q_low
+
+    # m shorthand
+    if q_low == "m":
+        return "min"
+
+    # m7/m9/m11 shorthand
+    if q_low.startswith("m") and len(q_low) > 1 and q_low[1].isdigit():
+        return "min" + q_low[1:]
+
+    # min* already ok
+    if q_low.startswith("min"):
+        return q_low
+
+    # sus / add9 / 6 / 6add9 etc
+    return q_low
+
+
+def _normalize_chord_token(tok: str) -> str:
+    """
+    Normalizes a chord token like:
+      'C min7' -> 'Cmin7'
+      'Bb 6/9' -> 'Bb6add9'
+    Returns "" if invalid.
+    """
+    t = (tok or "").strip()
+    if not t:
+        return ""
+
+    t = _norm_dash(t)
+    t = t.replace(" ", "")
+    t = t.replace("6/9", "6add9").replace("6\\9", "6add9")
+    t = re.sub(r"[,\.;]+$", "", t)
+
+    m = re.match(r"^([A-G](?:#|b)?)(.*)$", t)
+    if not m:
+        return ""
+
+    root = m.group(1)
+    rest = m.group(2)
+
+    # normalize root case (C, Db, F#)
+    root = root[0].upper() + (root[1:] if len(root) > 1 else "")
+    if root not in NOTE_TO_PC:
+        return ""
+
+    qual = _normalize_quality(rest)
+    if qual not in QUAL_TO_INTERVALS:
+        return ""
+
+    return f"{root}{qual}"
+
+
+_META_PACK_RE = re.compile(r"^PACK\s*\d+\s*$")
+_META_BAR_RE = re.compile(r"^\s*(4|8|16)\s*-\s*BAR\s*$")
+_NOTE_LETTER_RE = re.compile(r"\b[A-G][#b]?\b")
+
+
+def _is_meta_line(line: str) -> bool:
+    """
+    Optional: keep meta skipping for common headers,
+    but smart extraction would ignore them anyway.
+    """
+    s = (line or "").strip()
+    if not s:
+        return False
+
+    s_up = s.upper()
+
+    # PACK headers
+    if s_up.startswith("PACK") or _META_PACK_RE.match(s_up):
+        return True
+
+    # bar section headers
+    if s_up in ("4-BAR", "8-BAR", "16-BAR"):
+        return True
+    if _META_BAR_RE.match(s_up):
+        return True
+
+    return False
+
+
+# ---------------------------------------------------------
+# SMART CHORD EXTRACTION
+# ---------------------------------------------------------
+def _build_quality_regex() -> str:
+    # Longest first to avoid partial matches (sus2add9 before sus2, etc)
+    quals_sorted = sorted(list(QUAL_TO_INTERVALS.keys()), key=len, reverse=True)
+    return r"(?:%s)" % "|".join(re.escape(q) for q in quals_sorted)
+
+
+_QUAL_REGEX = _build_quality_regex()
+
+# Finds chords anywhere: Root + optional accidental + quality
+# Examples it catches: Cmin7, Dbmaj9, F#sus2add9, Bb6add9, Gadd9, Amin
+_CHORD_TOKEN_RE = re.compile(
+    rf"\b([A-G])([#b]?)\s*({_QUAL_REGEX})\b",
+    flags=re.IGNORECASE
+)
+
+
+# ---------------------------------------------------------
+# STREAMING LOADER
+# The upload is read in line-aligned byte chunks; each chunk is decoded and
+# parsed on its own, optionally on a process pool, so memory stays bounded
+# by a few chunks plus the index. _CHORD_TOKEN_RE yields root, accidental
+# and quality, which map straight to a chord ID (no second normalize pass).
+# ---------------------------------------------------------
+BANLIST_CHUNK_BYTES = 1 << 20
+BANLIST_WORKERS = 0                      # 0/1 = parse in-process
+BANLIST_PARALLEL_MIN_BYTES = 8 << 20     # smaller uploads are never fanned out
+
+
+def _extract_chord_ids(line: str) -> bytes:
+    """
+    Extract valid chords from messy text as chord-ID bytes,
+    e.g. "Cmin7 - Fsus2 / Bbmaj7" -> IDs of Cmin7, Fsus2, Bbmaj7.
+    """
+    s = _norm_dash(line)
+    s = s.replace("6/9", "6add9").replace("6\\9", "6add9")
+
+    out = bytearray()
+    last = None
+    for m in _CHORD_TOKEN_RE.finditer(s):
+        name = m.group(1) + m.group(2) + m.group(3).lower()
+        cid = CHORD_ID_BY_NAME.get(name)
+        # invalid spellings are skipped; immediate repeats collapse
+        if cid is None or name == last:
+            continue
+        last = name
+        out.append(cid)
+    return bytes(out)
+
+
+def _parse_banlist_chunk(data: bytes):
+    """Parse whole lines. Returns (entries, stats Counter, bad examples, line count)."""
+    entries: List[bytes] = []
+    stats = Counter()
+    bad_examples: List[str] = []
+    lines = data.decode("utf-8", errors="ignore").splitlines()
+
+    for raw in lines:
+        line = raw.strip()
+        if not line:
+            stats["empty"] += 1
+            continue
+
+        if _is_meta_line(line):
+            stats["ignored_meta"] += 1
+            continue
+
+        ids = _extract_chord_ids(line)
+        if len(ids) < 2:
+            # If it looks like it tried to be chords but we couldn't parse, log it.
+            low = line.lower()
+            looks_chordish = any(x in low for x in ("maj", "min", "sus", "add", "6"))
+            if looks_chordish and _NOTE_LETTER_RE.search(line) is not None:
+                stats["invalid"] += 1
+                if len(bad_examples) < 10:
+                    bad_examples.append(line[:160])
+            continue
+
+        stats["lines_with_chords"] += 1
+        entries.append(ids)
+        stats["added"] += 1
+
+    return entries, stats, bad_examples, len(lines)
+
+
+def _iter_line_chunks(stream, chunk_bytes: int):
+    """Yield byte chunks that end on a line break (the last one may not)."""
+    carry = b""
+    while True:
+        block = stream.read(chunk_bytes)
+        if not block:
+            break
+        buf = carry + block
+        cut = buf.rfind(b"\n")
+        if cut < 0:
+            # lone-CR files: never split a CR from a following LF
+            cut = buf.rfind(b"\r", 0, len(buf) - 1)
+        if cut < 0:
+            carry = buf
+            continue
+        carry = buf[cut + 1:]
+        yield buf[:cut + 1]
+    if carry:
+        yield carry
+
+
+def load_banlist_from_stream(
+    stream,
+    total_bytes: Optional[int] = None,
+    workers: int = BANLIST_WORKERS,
+    progress=None,
+    chunk_bytes: int = BANLIST_CHUNK_BYTES,
+) -> Tuple["BanIndex", Dict[str, int], List[str]]:
+    """
+    Smarter loader:
+    - Scans each line and extracts chords anywhere in the text
+    - Stores progressions with 2+ chords, as packed chord-ID codes
+    - Ignores the rest automatically
+    progress(bytes_done, total_bytes, lines_done) is called after every chunk.
+    stats also reports "lines" and "lines_per_sec".
+    """
+    t0 = time.perf_counter()
+    packed = []
+    stats = Counter({"added": 0, "invalid": 0, "empty": 0, "ignored_meta": 0, "lines_with_chords": 0})
+    bad_examples: List[str] = []
+    done = 0
+    lines = 0
+
+    parallel = workers > 1 and (total_bytes or 0) >= BANLIST_PARALLEL_MIN_BYTES
+    wave_size = max(1, workers * 2) if parallel else 1
+    chunks = _iter_line_chunks(stream, chunk_bytes)
+
+    while True:
+        wave = [c for _, c in zip(range(wave_size), chunks)]
+        if not wave:
+            break
+        results = _run_jobs(_parse_banlist_chunk, wave, workers) if parallel else [_parse_banlist_chunk(wave[0])]
+        for chunk, (entries, chunk_stats, bad, n_lines) in zip(wave, results):
+            packed.append(_pack_entries(entries))
+            stats.update(chunk_stats)
+            bad_examples.extend(bad[:10 - len(bad_examples)])
+            done += len(chunk)
+            lines += n_lines
+        if progress is not None:
+            progress(done, total_bytes, lines)
+
+    banned_set = BanIndex.from_codes(*(np.concatenate([p[k] for p in packed] or [_EMPTY_CODES]) for k in range(3)))
+
+    elapsed = time.perf_counter() - t0
+    stats["lines"] = lines
+    stats["lines_per_sec"] = (lines / elapsed) if elapsed > 0 else 0.0
+    return banned_set, dict(stats), bad_examples
+
+
+def load_banlist_from_txt_bytes(data: bytes, workers: int = BANLIST_WORKERS, progress=None) -> Tuple["BanIndex", Dict[str, int], List[str]]:
+    return load_banlist_from_stream(io.BytesIO(data), total_bytes=len(data), workers=workers, progress=progress)
+
+
+def progression_is_banned(chords: List[str], banned_set: Optional["BanIndex"]) -> bool:
+    """
+    ORDERED match (start matters). Generation checks ID bytes directly;
+    this is the entry point for chord names.
+    """
+    banned_set = _as_ban_index(banned_set)
+    if not banned_set or not chords:
+        return False
+
+    norm = [_normalize_chord_token(c) for c in chords]
+    if any(not x for x in norm):
+        return False
+
+    return chord_ids(norm) in banned_set
+
+
+# ---------------------------------------------------------
+# Packed codes: a progression of up to 8 chord IDs is one uint64, one byte
+# per chord holding id + 1 (big-endian). Slots are never 0, so codes of
+# different lengths never collide and numeric order is lexicographic order
+# within a length. Longer entries can never match a generated progression
+# (at most 6 chords) and are dropped.
+# ---------------------------------------------------------
+BAN_CODE_MAX_CHORDS = 8
+_ID_SLOT_TABLE = bytes((i + 1) % 256 for i in range(256))
+_SLOT_ID_TABLE = bytes((i - 1) % 256 for i in range(256))
+_EMPTY_CODES = np.zeros(0, dtype=np.uint64)
+_CODE_LENGTH_BOUNDS = np.array([1 << (8 * k) for k in range(1, BAN_CODE_MAX_CHORDS)], dtype=np.uint64)
+
+# Key-relative ("shape") form: every chord moved by the interval that puts
+# the first root on C. Index r maps IDs of a progression starting on root r.
+_N_QUALS = len(QUALITY_ORDER)
+_TO_C_TABLES = tuple(
+    bytes(chord_id(CHORD_ID_ROOT_PC[i] - r, CHORD_ID_QUAL[i]) if i < N_CHORD_IDS else i for i in range(256))
+    for r in range(12)
+)
+
+
+def _pack_ids(ids: bytes) -> int:
+    """Chord-ID bytes -> code (0 when too long to pack)."""
+    if len(ids) > BAN_CODE_MAX_CHORDS:
+        return 0
+    return int.from_bytes(ids.translate(_ID_SLOT_TABLE), "big")
+
+
+def _group_by_length(entries) -> Dict[int, Tuple[List[int], np.ndarray]]:
+    """length -> (positions in entries, (rows x length) uint64 slot matrix); unpackable entries skipped."""
+    by_len: Dict[int, Tuple[List[int], List[bytes]]] = {}
+    for j, ids in enumerate(entries):
+        if 0 < len(ids) <= BAN_CODE_MAX_CHORDS:
+            pos, group = by_len.setdefault(len(ids), ([], []))
+            pos.append(j)
+            group.append(ids)
+    return {
+        n: (pos, np.frombuffer(b"".join(group).translate(_ID_SLOT_TABLE), dtype=np.uint8).reshape(-1, n).astype(np.uint64))
+        for n, (pos, group) in by_len.items()
+    }
+
+
+def _slot_codes(slots: np.ndarray) -> np.ndarray:
+    """Row codes of a (rows x width) slot matrix."""
+    width = slots.shape[1]
+    weights = np.array([1 << (8 * (width - 1 - j)) for j in range(width)], dtype=np.uint64)
+    return (slots * weights).sum(axis=1, dtype=np.uint64)
+
+
+def _shape_codes(slots: np.ndarray) -> np.ndarray:
+    """Codes of each row transposed so its first root is C."""
+    ids = slots - np.uint64(1)
+    roots = ids // np.uint64(_N_QUALS)
+    shifted = (roots + np.uint64(12) - roots[:, :1]) % np.uint64(12)
+    return _slot_codes(shifted * np.uint64(_N_QUALS) + ids % np.uint64(_N_QUALS) + np.uint64(1))
+
+
+def _rotation_codes(slots: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(codes, least-rotation codes) of a slot matrix."""
+    rotated = [_slot_codes(np.roll(slots, -r, axis=1)) for r in range(slots.shape[1])]
+    return rotated[0], np.minimum.reduce(rotated)
+
+
+def _pack_entries(entries) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(codes, least-rotation codes, shape codes) for a batch of entries, vectorized per length."""
+    codes, rots, shapes = [_EMPTY_CODES], [_EMPTY_CODES], [_EMPTY_CODES]
+    for _, slots in _group_by_length(entries).values():
+        c, r = _rotation_codes(slots)
+        codes.append(c)
+        rots.append(r)
+        shapes.append(_shape_codes(slots))
+    return np.concatenate(codes), np.concatenate(rots), np.concatenate(shapes)
+
+
+def _sorted_codes(codes: np.ndarray) -> np.ndarray:
+    out = np.unique(np.asarray(codes, dtype=np.uint64))
+    out.setflags(write=False)
+    return out
+
+
+def _member(sorted_codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Vectorized membership of query codes in a sorted code array."""
+    if not sorted_codes.size:
+        return np.zeros(len(query), dtype=bool)
+    pos = np.minimum(np.searchsorted(sorted_codes, query), sorted_codes.size - 1)
+    return sorted_codes[pos] == query
+
+
+class BanIndex:
+    """
+    Banned progressions as three sorted, read-only uint64 arrays:
+    - codes:       the entries themselves (exact matches, and fragments)
+    - rot_codes:   each entry's least rotation, so any rotation is one search
+    - shape_codes: each entry moved to start on C, so any key is one search
+    `ids in index` checks with the index's mode; with_mode() gives a view
+    over the same arrays, contains_many() checks a batch at once. About
+    24 bytes per entry, shared by every session that loaded the same list.
+    Single exact checks (one per generation attempt) go through a frozenset
+    of the entries' ID bytes, built on first use and shared by every view.
+    """
+    __slots__ = ("mode", "codes", "rot_codes", "shape_codes", "lengths", "_views", "_exact")
+
+    def __init__(self, entries=(), mode: str = "exact"):
+        if mode not in BAN_MODES:
+            raise ValueError(f"Unknown ban mode '{mode}'.")
+        self.mode = mode
+        self._set_codes(*_pack_entries(entries))
+
+    def _set_codes(self, codes: np.ndarray, rot_codes: np.ndarray, shape_codes: np.ndarray, presorted: bool = False):
+        self.codes = codes if presorted else _sorted_codes(codes)
+        self.rot_codes = rot_codes if presorted else _sorted_codes(rot_codes)
+        self.shape_codes = shape_codes if presorted else _sorted_codes(shape_codes)
+        self._views = None
+        self._exact = [None]    # holder, so with_mode() views share one set
+        # chord counts present, for fragment checks
+        lengths = np.searchsorted(_CODE_LENGTH_BOUNDS, self.codes, side="right") + 1
+        self.lengths = tuple(int(n) for n in np.unique(lengths))
+
+    @classmethod
+    def from_codes(
+        cls, codes: np.ndarray, rot_codes: np.ndarray, shape_codes: np.ndarray, presorted: bool = False
+    ) -> "BanIndex":
+        index = cls()
+        index._set_codes(codes, rot_codes, shape_codes, presorted)
+        return index
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return self.codes, self.rot_codes, self.shape_codes
+
+    def with_mode(self, mode: str) -> "BanIndex":
+        view = BanIndex(mode=mode)
+        view.codes, view.rot_codes, view.shape_codes = self.arrays()
+        view.lengths = self.lengths
+        view._exact = self._exact
+        return view
+
+    def __getstate__(self):
+        return self.mode, self.arrays(), self.lengths
+
+    def __setstate__(self, state):
+        self.mode, (self.codes, self.rot_codes, self.shape_codes), self.lengths = state
+        self._views = None
+        self._exact = [None]
+
+    def _search_views(self):
+        # uint64 memoryviews: bisect on them beats a numpy call for one lookup
+        if self._views is None:
+            self._views = tuple(memoryview(np.ascontiguousarray(a)).cast("B").cast("Q") for a in self.arrays())
+        return self._views
+
+    def _exact_ids(self) -> frozenset:
+        # ~75 bytes per entry on top of the arrays; one hash probe instead of pack + bisect
+        if self._exact[0] is None:
+            raw = self.codes.astype(">u8").tobytes()
+            self._exact[0] = frozenset(
+                raw[i:i + 8].lstrip(b"\0").translate(_SLOT_ID_TABLE) for i in range(0, len(raw), 8)
+            )
+        return self._exact[0]
+
+    def lookup(self) -> Optional[Container]:
+        """Fastest container for repeated `in` checks in this mode (None when empty)."""
+        if not self.codes.size:
+            return None
+        return self._exact_ids() if self.mode == "exact" else self
+
+    def merged(self, other: "BanIndex") -> "BanIndex":
+        return BanIndex.from_codes(*(np.concatenate([a, b]) for a, b in zip(self.arrays(), other.arrays())))
+
+    def __len__(self) -> int:
+        return int(self.codes.size)
+
+    def __bool__(self) -> bool:
+        return bool(self.codes.size)
+
+    def __contains__(self, ids) -> bool:
+        if self.mode == "exact":
+            exact = self._exact[0]
+            return ids in (exact if exact is not None else self._exact_ids())
+        if not ids or not self.codes.size:
+            return False
+        if self.mode == "contains":
+            return self.contains_fragment(ids)
+        codes_view, rot_view, shape_view = self._search_views()
+        if self.mode == "transposed":
+            # one translate puts the first root on C; the ban check stays a single search
+            view, code = shape_view, _pack_ids(ids.translate(_TO_C_TABLES[CHORD_ID_ROOT_PC[ids[0]]]))
+        elif self.mode == "rotation":
+            # equal-length codes order like their bytes, so the least rotation is the smallest window
+            n = len(ids)
+            if not 0 < n <= BAN_CODE_MAX_CHORDS:
+                return False
+            big = int.from_bytes((ids + ids[:n - 1]).translate(_ID_SLOT_TABLE), "big")
+            mask = (1 << (8 * n)) - 1
+            view, code = rot_view, min((big >> (8 * s)) & mask for s in range(n))
+        i = bisect.bisect_left(view, code)
+        return i < len(view) and view[i] == code
+
+    def contains_fragment(self, ids: bytes) -> bool:
+        # every cyclic window of every banned length, cut out of one big int
+        n = len(ids)
+        loop = ids + ids[:n - 1]
+        big = int.from_bytes(loop.translate(_ID_SLOT_TABLE), "big")
+        view = self._search_views()[0]
+        size, left = len(view), bisect.bisect_left
+        for length in self.lengths:
+            if length > n:
+                break
+            mask = (1 << (8 * length)) - 1
+            for shift in range(8 * (len(loop) - length), 8 * (len(loop) - length - n), -8):
+                code = (big >> shift) & mask
+                i = left(view, code)
+                if i < size and view[i] == code:
+                    return True
+        return False
+
+    def contains_many(self, progs) -> np.ndarray:
+        """Batched check: bool array, one per chord-ID bytes in progs (vectorized per length)."""
+        progs = list(progs)
+        out = np.zeros(len(progs), dtype=bool)
+        if not self.codes.size:
+            return out
+        for n, (pos, slots) in _group_by_length(progs).items():
+            if self.mode == "exact":
+                hit = _member(self.codes, _slot_codes(slots))
+            elif self.mode == "rotation":
+                hit = _member(self.rot_codes, _rotation_codes(slots)[1])
+            elif self.mode == "transposed":
+                hit = _member(self.shape_codes, _shape_codes(slots))
+            else:
+                loop = np.concatenate([slots, slots[:, :n - 1]], axis=1)
+                hit = np.zeros(len(pos), dtype=bool)
+                for length in self.lengths:
+                    if length > n:
+                        break
+                    for i in range(n):
+                        hit |= _member(self.codes, _slot_codes(loop[:, i:i + length]))
+            out[pos] = hit
+        if self.mode == "contains":
+            # too long to pack whole, but their windows still can be
+            for j, p in enumerate(progs):
+                if len(p) > BAN_CODE_MAX_CHORDS:
+                    out[j] = self.contains_fragment(p)
+        return out
+
+
+def _as_ban_index(ban_set) -> BanIndex:
+    """
+    None -> empty index; a BanIndex passes through. A plain set of the old
+    kind (chord-name tuples, or chord-ID bytes) is converted, since set
+    members never match the ID bytes generation looks up.
+    """
+    if ban_set is None:
+        return BanIndex()
+    if isinstance(ban_set, BanIndex):
+        return ban_set
+    if not isinstance(ban_set, (set, frozenset)):
+        raise TypeError(f"ban_set must be a BanIndex, not {type(ban_set).__name__}.")
+    entries = []
+    for item in ban_set:
+        if isinstance(item, (bytes, bytearray)):
+            entries.append(bytes(item))
+        elif isinstance(item, (tuple, list)) and all(isinstance(c, str) for c in item):
+            ids = chord_ids([_normalize_chord_token(c) for c in item])
+            if ids is None:
+                raise TypeError(f"ban_set entry {item!r} has a chord outside the vocabulary.")
+            entries.append(ids)
+        else:
+            raise TypeError(f"ban_set entries must be chord-name tuples or chord-ID bytes, not {type(item).__name__}.")
+    return BanIndex(entries)
+
+
+# ---------------------------------------------------------
+# BANLIST CACHE
+# Parsed banlists keyed by the SHA-256 of the upload: a process-wide LRU
+# (module state, so every session and CLI call shares it) plus an optional on-disk tier
+# holding the index's sorted .npy code arrays, memory-mapped on load. An
+# upload that extends a cached banlist only parses the appended lines.
+# ---------------------------------------------------------
+BANLIST_CACHE_VERSION = 3            # bump when chord IDs, codes or parsing rules change
+BANLIST_CACHE_MAX_ENTRIES = 8
+BANLIST_CACHE_DIR = os.environ.get("AA_BANLIST_CACHE_DIR", "")   # "" = memory only
+_BANLIST_ARRAY_FILES = ("codes.npy", "rot.npy", "shape.npy")
+
+
+class _BanlistMemory:
+    __slots__ = ("entries", "lock")
+
+    def __init__(self):
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()   # key -> (index, stats, examples, size)
+        self.lock = threading.Lock()
+
+
+_BANLIST_MEMORY = _BanlistMemory()
+
+
+def _banlist_memory() -> _BanlistMemory:
+    return _BANLIST_MEMORY
+
+
+def _banlist_cache_path(key: str) -> str:
+    return os.path.join(BANLIST_CACHE_DIR, key[:2], key)
+
+
+def _hash_with_prefixes(data: bytes, sizes) -> Tuple[str, Dict[int, str]]:
+    """SHA-256 of data plus of each strict prefix data[:size], in one pass."""
+    view = memoryview(data)
+    h = hashlib.sha256()
+    pos = 0
+    prefixes = {}
+    for size in sorted(set(sizes)):
+        if size <= 0 or size >= len(data):
+            continue
+        h.update(view[pos:size])
+        pos = size
+        prefixes[size] = h.copy().hexdigest()
+    h.update(view[pos:])
+    return h.hexdigest(), prefixes
+
+
+def _banlist_disk_put(key: str, index: BanIndex, stats: dict, examples: List[str], size: int):
+    path = _banlist_cache_path(key)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(tmp, exist_ok=True)
+        for name, arr in zip(_BANLIST_ARRAY_FILES, index.arrays()):
+            np.save(os.path.join(tmp, name), arr)
+        meta = {"version": BANLIST_CACHE_VERSION, "size": size, "stats": stats, "examples": examples}
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, path)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _banlist_disk_meta(path: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return meta if meta.get("version") == BANLIST_CACHE_VERSION else None
+
+
+def _banlist_disk_get(key: str) -> Optional[tuple]:
+    path = _banlist_cache_path(key)
+    meta = _banlist_disk_meta(path)
+    if meta is None:
+        return None
+    try:
+        # sorted on save; memory-mapped read-only, so the OS shares the pages
+        arrays = [np.load(os.path.join(path, name), mmap_mode="r") for name in _BANLIST_ARRAY_FILES]
+    except (OSError, ValueError):
+        return None
+    index = BanIndex.from_codes(*arrays, presorted=True)
+    return index, meta["stats"], meta["examples"], meta["size"]
+
+
+def _banlist_known_sizes(memory: _BanlistMemory) -> Dict[str, int]:
+    """key -> upload size for every cached banlist (memory and disk)."""
+    with memory.lock:
+        known = {k: v[3] for k, v in memory.entries.items()}
+    if BANLIST_CACHE_DIR and os.path.isdir(BANLIST_CACHE_DIR):
+        for sub in os.listdir(BANLIST_CACHE_DIR):
+            subdir = os.path.join(BANLIST_CACHE_DIR, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for key in os.listdir(subdir):
+                if key not in known and not key.endswith(".tmp"):
+                    meta = _banlist_disk_meta(os.path.join(subdir, key))
+                    if meta is not None:
+                        known[key] = int(meta["size"])
+    return known
+
+
+def _banlist_cache_get(memory: _BanlistMemory, key: str) -> Optional[tuple]:
+    with memory.lock:
+        hit = memory.entries.get(key)
+        if hit is not None:
+            memory.entries.move_to_end(key)
+            return hit
+    if BANLIST_CACHE_DIR:
+        hit = _banlist_disk_get(key)
+        if hit is not None:
+            _banlist_cache_put(memory, key, hit, persist=False)
+        return hit
+    return None
+
+
+def _banlist_cache_put(memory: _BanlistMemory, key: str, value: tuple, persist: bool = True):
+    with memory.lock:
+        memory.entries[key] = value
+        memory.entries.move_to_end(key)
+        while len(memory.entries) > BANLIST_CACHE_MAX_ENTRIES:
+            memory.entries.popitem(last=False)
+    if persist and BANLIST_CACHE_DIR:
+        _banlist_disk_put(key, *value)
+
+
+def load_banlist_cached(
+    data: bytes,
+    workers: int = BANLIST_WORKERS,
+    progress=None,
+) -> Tuple[BanIndex, Dict[str, int], List[str]]:
+    """
+    load_banlist_from_txt_bytes behind the content-hash cache.
+    stats["source"] is "memory", "disk", "append" (only new lines parsed) or
+    "parsed"; stats["load_ms"] is the time this call took.
+    """
+    t0 = time.perf_counter()
+    memory = _banlist_memory()
+    known = _banlist_known_sizes(memory)
+    key, prefixes = _hash_with_prefixes(data, known.values())
+
+    with memory.lock:
+        in_memory = key in memory.entries
+    hit = _banlist_cache_get(memory, key)
+    if hit is not None:
+        index, stats, examples, _ = hit
+        stats = dict(stats, source="memory" if in_memory else "disk")
+    else:
+        base = None
+        # longest cached prefix that ends on a line break
+        for size in sorted(prefixes, reverse=True):
+            prefix_key = prefixes[size]
+            if known.get(prefix_key) == size and data[size - 1:size] == b"\n":
+                base = _banlist_cache_get(memory, prefix_key)
+                if base is not None:
+                    break
+
+        if base is None:
+            index, stats, examples = load_banlist_from_txt_bytes(data, workers=workers, progress=progress)
+            stats = dict(stats, source="parsed")
+        else:
+            base_index, base_stats, base_examples, base_size = base
+            tail = data[base_size:]
+            tail_index, tail_stats, tail_examples = load_banlist_from_txt_bytes(tail, workers=workers, progress=progress)
+            index = base_index.merged(tail_index)
+            stats = {k: base_stats.get(k, 0) + tail_stats.get(k, 0) for k in tail_stats if k != "lines_per_sec"}
+            stats["lines_per_sec"] = tail_stats["lines_per_sec"]
+            stats["source"] = "append"
+            examples = (list(base_examples) + tail_examples)[:10]
+
+        _banlist_cache_put(memory, key, (index, stats, examples, len(data)))
+
+    stats["load_ms"] = (time.perf_counter() - t0) * 1000.0
+    return index, stats, examples
+
+
+
+# =========================================================
+# GENERATOR SETTINGS
+# =========================================================
+PATTERN_MAX_REPEATS = 1
+MAX_PATTERN_DUPLICATE_RATIO = 0.01
+
+TOTAL_BARS_DISTRIBUTION = {8: 0.40, 4: 0.35, 16: 0.25}
+CHORDCOUNT_DISTRIBUTION = {4: 0.40, 3: 0.35, 2: 0.20, 5: 0.03, 6: 0.02}
+
+LIMIT_NOTECOUNT_JUMPS = True
+MAX_BIG_JUMPS_PER_PROG = 1
+
+MIN_SHARED_TONES = 1
+ENFORCE_LOOP_OK = True
+MAX_TRIES_PER_PROG = 40000
+
+# SUS SAFETY SYSTEM
+SUS_QUALITIES = ("sus2", "sus4", "sus2add9", "sus4add9")
+SUS_HEAVY_THRESHOLD = 1.35     # avg sus balance factor that switches to "heavy" rules
+
+DEFAULT_SUS_MAX_RATIO = 0.45
+DEFAULT_SUS4_MAX_COUNT = 1
+DEFAULT_NEED_IF_SUS = 2
+DEFAULT_NEED_IF_SUS4 = 3
+
+HEAVY_NEED = 2
+HEAVY_NEED_IF_SUS4 = 3
+HEAVY_REQUIRE_STEP_OR_REPEAT = True
+
+ALLOW_SUS4_TO_SUS4_IF_SAFE = True
+
+# caps after the "sus_safety" relaxation rung (see GENERATION BUDGET); sus starts are allowed too
+RELAXED_SUS_MAX_RATIO = 0.75
+RELAXED_SUS4_MAX_COUNT = 2
+
+# Pools (main control for maj/min/sus flavor)
+MAJ_POOL_BASE = [("maj9", 10), ("maj7", 9), ("add9", 7), ("6add9", 5), ("6", 4), ("maj", 3)]
+MIN_POOL_BASE = [("min9", 10), ("min7", 9), ("min11", 4), ("min", 3)]
+SUS_POOL_BASE = [("sus2add9", 1), ("sus4add9", 1), ("sus2", 2), ("sus4", 2)]
+
+SAFE_FALLBACK_ORDER = [
+    "maj9", "maj7", "add9", "6add9", "6",
+    "min9", "min7", "min11",
+    "maj", "min",
+    "sus2add9", "sus4add9", "sus2", "sus4"
+]
+
+TEMPLATES_BY_LEN = {
+    2: [((0, 3), 10), ((0, 5), 7), ((5, 3), 5), ((3, 0), 4), ((0, 4), 3)],
+    3: [
+        ((0, 5, 3), 14), ((0, 3, 4), 12), ((0, 3, 5), 10), ((0, 5, 4), 9),
+        ((0, 2, 3), 7), ((0, 2, 5), 6), ((3, 5, 0), 5), ((5, 3, 0), 5),
+        ((0, 1, 3), 3), ((0, 6, 3), 2),
+    ],
+    4: [
+        ((0, 5, 3, 4), 18), ((0, 5, 3, 0), 12), ((0, 3, 4, 3), 12), ((0, 3, 5, 3), 12),
+        ((0, 2, 5, 3), 10), ((0, 2, 3, 4), 10), ((0, 1, 3, 4), 6), ((0, 1, 3, 0), 5),
+        ((5, 3, 4, 0), 5), ((3, 4, 0, 5), 4), ((0, 4, 3, 5), 4),
+    ],
+    5: [((0, 5, 3, 4, 3), 4), ((0, 3, 0, 5, 3), 3), ((0, 2, 3, 4, 3), 3)],
+    6: [((0, 5, 3, 4, 3, 0), 3), ((0, 3, 0, 5, 3, 0), 3)],
+}
+
+
+DURATIONS = {
+    (2, 4): [([2, 2], 10)],
+    (3, 4): [([2, 1, 1], 10), ([1, 1, 2], 8)],
+    (4, 4): [([1, 1, 1, 1], 12)],
+
+    (2, 8): [([4, 4], 12)],
+    (3, 8): [([4, 2, 2], 10), ([2, 2, 4], 9), ([2, 4, 2], 2), ([3, 3, 2], 1)],
+    (4, 8): [([2, 2, 2, 2], 12), ([4, 2, 1, 1], 1), ([2, 1, 1, 4], 1), ([1, 1, 2, 4], 0), ([4, 1, 1, 2], 1)],
+    (5, 8): [([2, 2, 2, 1, 1], 3), ([1, 2, 2, 2, 1], 1), ([2, 1, 2, 1, 2], 7), ([2, 2, 1, 2, 1], 3)],
+    (6, 8): [([2, 1, 1, 2, 1, 1], 5), ([1, 1, 1, 1, 2, 2], 1), ([1, 1, 2, 1, 1, 2], 4), ([2, 1, 2, 1, 1, 1], 3)],
+
+    (2, 16): [([8, 8], 8)],
+    (3, 16): [([8, 4, 4], 4), ([4, 4, 8], 3), ([6, 6, 4], 3)],
+    (4, 16): [([4, 4, 4, 4], 12), ([6, 4, 4, 2], 4)],
+    (5, 16): [([4, 4, 4, 2, 2], 3), ([2, 2, 4, 4, 4], 3), ([4, 2, 4, 2, 4], 7), ([2, 4, 4, 4, 2], 3)],
+    (6, 16): [([4, 2, 2, 4, 2, 2], 5), ([4, 2, 2, 2, 2, 4], 4), ([2, 4, 2, 4, 2, 2], 5)],
+}
+VALID_COMBOS = sorted(list(DURATIONS.keys()))
+
+
+def _valid_total_and_m_weights() -> List[Tuple[Tuple[int, int], float]]:
+    weighted = []
+    for (m, total) in VALID_COMBOS:
+        wt = TOTAL_BARS_DISTRIBUTION.get(total, 0.0) * CHORDCOUNT_DISTRIBUTION.get(m, 0.0)
+        if wt > 0:
+            weighted.append(((total, m), wt))
+    if not weighted:
+        raise RuntimeError("No valid (total,m) combos available.")
+    return weighted
+
+
+def _pattern_fingerprint(degs, quals):
+    return (tuple(degs), tuple(quals))
+
+
+# =========================================================
+# CHORD TYPE BALANCE (ADVANCED) + STRICT MODE
+# =========================================================
+STRICT_SLIDERS = True
+
+ADV_ALL_QUALITIES = [
+    "maj9", "maj7", "add9", "6add9", "6", "maj",
+    "min9", "min7", "min11", "min",
+    "sus2add9", "sus4add9", "sus2", "sus4",
+]
+ADV_DEFAULT_VALUE = 50
+
+
+def _balance_factor(v: int) -> float:
+    v = int(max(0, min(100, v)))
+    if v == 0:
+        return 0.0
+    if v == 50:
+        return 1.0
+    if v < 50:
+        return max(0.02, v / 50.0)
+    return 1.0 + ((v - 50) / 50.0) * 1.0
+
+
+def _enabled_qualities(balance: Optional[Dict[str, int]]) -> List[str]:
+    if (not ENABLE_CHORD_BALANCE_FEATURE) or (not balance):
+        return ADV_ALL_QUALITIES[:]
+    return [q for q in ADV_ALL_QUALITIES if int(balance.get(q, ADV_DEFAULT_VALUE)) > 0]
+
+
+def _build_deg_allowed(balance: Optional[Dict[str, int]], key: str) -> Dict[int, List[Tuple[str, float]]]:
+    enabled = _enabled_qualities(balance)
+
+    if STRICT_SLIDERS and balance and len(enabled) == 0:
+        raise RuntimeError("All chord-type sliders are 0. Enable at least one chord type.")
+
+    out: Dict[int, List[Tuple[str, float]]] = {}
+    for deg in range(7):
+        diatonic = DIATONIC_QUALS[(key, deg)]
+        items: List[Tuple[str, float]] = []
+
+        for q in enabled:
+            if q in diatonic:
+                w = 1.0
+                if balance:
+                    w = max(1e-9, _balance_factor(balance.get(q, ADV_DEFAULT_VALUE)))
+                items.append((q, w))
+
+        out[deg] = items
+
+    return out
+
+
+def _dedupe_inside_progression(rng: random.Random, key: str, degs: list, quals: list):
+    scale = SCALES[key]
+    deg_pc = KEY_DEGREE_PC[key]
+    used = set()
+
+    for i in range(len(degs)):
+        d = degs[i]
+        root = scale[d]
+        q = quals[i]
+        sym = chord_id(deg_pc[d], q)
+
+        if sym not in used:
+            used.add(sym)
+            continue
+
+        candidate_quals = SAFE_FALLBACK_ORDER[:]
+        rng.shuffle(candidate_quals)
+        fixed = False
+        for q2 in candidate_quals:
+            if q2 == q:
+                continue
+            if _is_diatonic_chord(key, root, q2):
+                sym2 = chord_id(deg_pc[d], q2)
+                if sym2 not in used:
+                    quals[i] = q2
+                    used.add(sym2)
+                    fixed = True
+                    break
+        if fixed:
+            continue
+
+        neighbor_steps = [1, -1, 2, -2, 3, -3]
+        rng.shuffle(neighbor_steps)
+        for stp in neighbor_steps:
+            d2 = (d + stp) % 7
+            root2 = scale[d2]
+
+            if _is_diatonic_chord(key, root2, q) and chord_id(deg_pc[d2], q) not in used:
+                degs[i] = d2
+                used.add(chord_id(deg_pc[d2], q))
+                fixed = True
+                break
+
+            cand2 = SAFE_FALLBACK_ORDER[:]
+            rng.shuffle(cand2)
+            for q2 in cand2:
+                if _is_diatonic_chord(key, root2, q2) and chord_id(deg_pc[d2], q2) not in used:
+                    degs[i] = d2
+                    quals[i] = q2
+                    used.add(chord_id(deg_pc[d2], q2))
+                    fixed = True
+                    break
+            if fixed:
+                break
+
+        if not fixed:
+            return None
+
+    return degs, quals
+
+
+def _is_sus(q: str) -> bool:
+    return q.startswith("sus")
+
+
+def _is_sus4ish(q: str) -> bool:
+    return q.startswith("sus4")
+
+
+def _pc_interval(a: int, b: int) -> int:
+    iv = abs((b - a) % 12)
+    return min(iv, 12 - iv)
+
+
+def _sus_start_allowed(chord_balance: Optional[Dict[str, int]]) -> bool:
+    if not chord_balance:
+        return False
+    return any(chord_balance.get(k, ADV_DEFAULT_VALUE) > 80 for k in SUS_QUALITIES)
+
+
+def _is_sus_heavy(chord_balance: Optional[Dict[str, int]]) -> bool:
+    avg_sus_weight = 1.0
+    if chord_balance:
+        vals = [_balance_factor(chord_balance.get(k, ADV_DEFAULT_VALUE)) for k in SUS_QUALITIES]
+        avg_sus_weight = sum(vals) / len(vals)
+    return avg_sus_weight >= SUS_HEAVY_THRESHOLD
+
+
+def _transition_ok(qa: str, qb: str, mask_a: int, mask_b: int, pc_a: int, pc_b: int, sus_heavy: bool) -> bool:
+    """
+    Shared-tone / sus4 rule for one chord -> chord move (a -> b).
+    """
+    shared = _shared_tones(mask_a, mask_b)
+    sus4_pair = _is_sus4ish(qa) and _is_sus4ish(qb)
+
+    if sus_heavy:
+        need = HEAVY_NEED
+        if _is_sus4ish(qa) or _is_sus4ish(qb):
+            need = max(need, HEAVY_NEED_IF_SUS4)
+    else:
+        need = 1
+        if _is_sus(qa) or _is_sus(qb):
+            need = DEFAULT_NEED_IF_SUS
+        if _is_sus4ish(qa) or _is_sus4ish(qb):
+            need = max(need, DEFAULT_NEED_IF_SUS4)
+
+    if shared < need:
+        return False
+
+    if sus4_pair:
+        if not ALLOW_SUS4_TO_SUS4_IF_SAFE:
+            return False
+        if not (shared >= 3 or _pc_interval(pc_a, pc_b) <= 2 or pc_a == pc_b):
+            return False
+
+    return True
+
+
+def _big_notecount_jumps(quals: list) -> int:
+    big = 0
+    for a, b in zip(quals, quals[1:]):
+        if abs(QUALITY_NOTECOUNT[a] - QUALITY_NOTECOUNT[b]) >= 3:
+            big += 1
+    if ENFORCE_LOOP_OK and len(quals) >= 2:
+        if abs(QUALITY_NOTECOUNT[quals[-1]] - QUALITY_NOTECOUNT[quals[0]]) >= 3:
+            big += 1
+    return big
+
+
+def _progression_rule_failure(
+    key: str,
+    roots: list,
+    quals: list,
+    sus_heavy: bool,
+    sus_caps: Tuple[float, int] = (DEFAULT_SUS_MAX_RATIO, DEFAULT_SUS4_MAX_COUNT),
+) -> Optional[str]:
+    """
+    Deterministic rules applied after dedupe:
+    diatonic, shared tones, SUS SAFETY SYSTEM, note-count jumps.
+    sus_caps: (max sus ratio, max sus4 count) outside sus-heavy mode.
+    Returns the first broken rule's name, or None when all pass.
+    """
+    if any(not _is_diatonic_chord(key, r, q) for r, q in zip(roots, quals)):
+        return "non_diatonic"
+
+    if not _shared_tone_ok_loop(roots, quals, need=MIN_SHARED_TONES, loop=True):
+        return "shared_tones"
+
+    m = len(quals)
+    if not sus_heavy:
+        if sum(1 for q in quals if _is_sus(q)) / max(1, m) > sus_caps[0]:
+            return "sus_ratio"
+        if sum(1 for q in quals if _is_sus4ish(q)) > sus_caps[1]:
+            return "sus4_count"
+
+    masks = [_chord_pc_mask(r, q) for r, q in zip(roots, quals)]
+    root_pcs = [_pc(r) for r in roots]
+
+    step_moves = 0
+    for i in range(m):
+        j = (i + 1) % m
+        if _pc_interval(root_pcs[i], root_pcs[j]) <= 2:
+            step_moves += 1
+        if not _transition_ok(quals[i], quals[j], masks[i], masks[j], root_pcs[i], root_pcs[j], sus_heavy):
+            return "transition"
+
+    if sus_heavy and HEAVY_REQUIRE_STEP_OR_REPEAT:
+        has_repeat_root = (len(set(root_pcs)) < len(root_pcs))
+        if step_moves == 0 and (not has_repeat_root):
+            return "no_step_or_repeat"
+
+    if LIMIT_NOTECOUNT_JUMPS and _big_notecount_jumps(quals) > MAX_BIG_JUMPS_PER_PROG:
+        return "notecount_jumps"
+
+    return None
+
+
+def _build_progression(
+    rng: random.Random,
+    plan: "GenerationPlan",
+    key: str,
+    degs: tuple,
+    total_bars: int,
+    stats: Optional["GenerationStats"] = None,
+):
+    pools = plan.deg_pools[key]
+    quals = []
+    for d in degs:
+        q = pools[d].draw(rng)
+        if q is None:
+            return _rejected(stats, "empty_pool")
+        quals.append(q)
+
+    if _is_sus(quals[0]) and not plan.sus_start_ok:
+        return _rejected(stats, "sus_start")
+
+    ded = _dedupe_inside_progression(rng, key, list(degs), quals[:])
+    if ded is None:
+        return _rejected(stats, "dedupe")
+    degs, quals = ded
+
+    roots = [SCALES[key][d] for d in degs]
+
+    reason = _progression_rule_failure(key, roots, quals, plan.sus_heavy, plan.sus_caps)
+    if reason is not None:
+        return _rejected(stats, reason)
+
+    deg_pc = KEY_DEGREE_PC[key]
+    ids = bytes(chord_id(deg_pc[d], q) for d, q in zip(degs, quals))
+    durs = plan.durations[(len(ids), total_bars)].draw(rng)
+
+    if _low_sim_count_loop(roots, quals, loop=ENFORCE_LOOP_OK) != 0:
+        return _rejected(stats, "low_sim")
+
+    return ids, durs, key, degs, quals
+
+
+def _pick_keys_even(n: int, rng: random.Random) -> list:
+    base = n // len(KEYS)
+    rem = n % len(KEYS)
+    out = []
+    for k in KEYS:
+        out += [k] * base
+    extra = KEYS[:]
+    rng.shuffle(extra)
+    out += extra[:rem]
+    rng.shuffle(out)
+    return out
+
+
+# =========================================================
+# GENERATION STATS (opt-in instrumentation)
+# Pass a GenerationStats to generate_progressions / build_pack(_bytes) to
+# count attempts, rejections by reason, and wall time per stage. Without
+# one, the cost is an `is None` check on rejection paths and per rendered
+# file. Render stages are timed for in-process rendering only; pooled
+# rendering is reported as one "render (pool)" stage.
+# =========================================================
+STATS_STAGES = ("generate", "validate", "voice", "register", "encode", "zip")
+
+
+class GenerationStats:
+    """Attempts, rejections by reason and per-stage milliseconds for one run."""
+    __slots__ = ("attempts", "accepted", "rejections", "stage_ms")
+
+    def __init__(self):
+        self.attempts = 0
+        self.accepted = 0
+        self.rejections: Counter = Counter()
+        self.stage_ms: Counter = Counter()
+
+    def reject(self, reason: str):
+        self.rejections[reason] += 1
+
+    def add_time(self, stage: str, t0: float) -> float:
+        """Charge perf_counter() - t0 to stage; returns now (the next stage's t0)."""
+        now = time.perf_counter()
+        self.stage_ms[stage] += (now - t0) * 1000.0
+        return now
+
+    def as_dict(self) -> dict:
+        stages = list(STATS_STAGES) + sorted(set(self.stage_ms) - set(STATS_STAGES))
+        return {
+            "attempts": self.attempts,
+            "accepted": self.accepted,
+            "rejections": dict(self.rejections.most_common()),
+            "stage_ms": {stage: self.stage_ms.get(stage, 0.0) for stage in stages},
+        }
+
+
+_STATS_LOCAL = threading.local()   # stats of the build running on this thread (render stages)
+
+
+def _active_stats() -> Optional[GenerationStats]:
+    return getattr(_STATS_LOCAL, "stats", None)
+
+
+def _rejected(stats: Optional[GenerationStats], reason: str):
+    if stats is not None:
+        stats.reject(reason)
+    return None
+
+
+# =========================================================
+# GENERATION BUDGET + RELAXATION LADDER (opt-in)
+# Pass a GenerationBudget to generate_progressions to bound a request by
+# wall time and/or attempts. Each slot then gets an adaptive try limit
+# (a multiple of the run's attempts per accepted progression). The next
+# rung of the ladder is applied, for the rest of the run, when a slot hits
+# that limit, or when the run falls behind schedule: with R relaxing rungs,
+# rung k is due once k/(R+1) of the budget is spent and a smaller share of
+# the progressions is built.
+#   pattern_dupes  repeated progression shapes beyond MAX_PATTERN_DUPLICATE_RATIO
+#   sus_safety     sus starts allowed, RELAXED_SUS_* caps
+#   fewer          skip slots that still fail; stop when the budget is spent
+# Without "fewer", a spent budget raises RuntimeError. The budget is
+# filled in place with what was relaxed. Without a budget, generation is
+# unchanged (MAX_TRIES_PER_PROG per slot, no relaxation). With workers>=1 a
+# budgeted call draws the per-progression streams in-process, not in the
+# pool, so every attempt is charged as it is made.
+# =========================================================
+RELAX_PATTERN_DUPES = "pattern_dupes"
+RELAX_SUS_SAFETY = "sus_safety"
+RELAX_FEWER = "fewer"
+RELAXATION_LADDER = (RELAX_PATTERN_DUPES, RELAX_SUS_SAFETY, RELAX_FEWER)
+RELAXATION_LABELS = {
+    RELAX_PATTERN_DUPES: "allowed repeated progression shapes",
+    RELAX_SUS_SAFETY: "loosened the sus-chord limits",
+    RELAX_FEWER: "returned fewer progressions",
+}
+ADAPTIVE_TRIES_FACTOR = 25      # a slot may take 25x the run's mean attempts per accept...
+ADAPTIVE_MIN_TRIES = 500        # ...but at least this many (and at most MAX_TRIES_PER_PROG)
+
+
+class GenerationBudget:
+    """
+    Limits for one generate_progressions call, plus what it had to relax.
+    deadline_s: wall-clock seconds; max_attempts: candidate draws (deterministic).
+    A deadline makes what gets relaxed depend on machine load, so the same seed
+    can give a different result; bound seeded runs by max_attempts alone.
+    ladder: rungs from RELAXATION_LADDER, applied in the given order.
+    """
+    __slots__ = ("deadline_s", "max_attempts", "ladder",
+                 "relaxed", "requested", "built", "attempts", "exhausted", "elapsed_ms",
+                 "_t0", "_t_end", "_paused_at", "_used", "_rungs")
+
+    def __init__(
+        self,
+        deadline_s: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+        ladder: Tuple[str, ...] = RELAXATION_LADDER,
+    ):
+        unknown = [r for r in ladder if r not in RELAXATION_LADDER]
+        if unknown:
+            raise ValueError(f"Unknown relaxation rung(s): {', '.join(unknown)}.")
+        self.deadline_s = deadline_s
+        self.max_attempts = max_attempts
+        self.ladder = tuple(ladder)
+        self._rungs = tuple(r for r in self.ladder if r != RELAX_FEWER)
+        self.start(0)
+
+    def start(self, n: int):
+        self.relaxed: List[str] = []
+        self.requested = n
+        self.built = 0
+        self.attempts = 0
+        self.exhausted: Optional[str] = None    # "deadline" | "attempts" once spent
+        self.elapsed_ms = 0.0
+        self._t0 = time.monotonic()
+        self._t_end = None if self.deadline_s is None else self._t0 + self.deadline_s
+        self._paused_at: Optional[float] = self._t0     # the clock runs only inside the generator
+        self._used = 0.0    # share of the budget spent, 0..1
+
+    def resume(self):
+        """Restart the clock; the time since pause() is not charged."""
+        if self._paused_at is not None:
+            away = time.monotonic() - self._paused_at
+            self._t0 += away
+            if self._t_end is not None:
+                self._t_end += away
+            self._paused_at = None
+
+    def pause(self):
+        """Stop the clock while control is outside the generator."""
+        if self._paused_at is None:
+            self._paused_at = time.monotonic()
+            self.elapsed_ms = (self._paused_at - self._t0) * 1000.0
+
+    def spend(self) -> bool:
+        """Charge one attempt; False (nothing charged) once the deadline or attempt cap is reached."""
+        if self.exhausted is not None:
+            return False
+        used = 0.0
+        if self.max_attempts is not None:
+            if self.attempts >= self.max_attempts:
+                self.exhausted = "attempts"
+                return False
+            used = self.attempts / self.max_attempts
+        if self._t_end is not None:
+            now = time.monotonic()
+            if now >= self._t_end:
+                self.exhausted = "deadline"
+                return False
+            used = max(used, (now - self._t0) / self.deadline_s)
+        self._used = used
+        self.attempts += 1
+        return True
+
+    def behind_schedule(self) -> bool:
+        """The next relaxing rung is due: its share of the budget is spent, with fewer built."""
+        k = len(self.relaxed)
+        if k >= len(self._rungs) or RELAX_FEWER in self.relaxed:
+            return False
+        return self._used * (len(self._rungs) + 1) >= k + 1 and self.built < self._used * self.requested
+
+    def try_limit(self) -> int:
+        mean = (self.attempts + 1) / (self.built + 1)
+        return int(min(MAX_TRIES_PER_PROG, max(ADAPTIVE_MIN_TRIES, ADAPTIVE_TRIES_FACTOR * mean)))
+
+    def next_rung(self) -> Optional[str]:
+        """Record the next relaxing rung (ladder order, "fewer" excluded); None when none are left."""
+        for rung in self._rungs:
+            if rung not in self.relaxed:
+                self.relaxed.append(rung)
+                return rung
+        return None
+
+    def summary(self) -> str:
+        """One line for the UI/CLI; empty when nothing was relaxed."""
+        parts = [RELAXATION_LABELS[r] for r in self.relaxed if r != RELAX_FEWER]
+        if RELAX_FEWER in self.relaxed:
+            parts.append(f"returned {self.built} of {self.requested} progressions")
+        if not parts:
+            return ""
+        head = "Relaxed to fit"
+        if self.exhausted == "deadline":
+            head = f"Time budget ran out after {self.elapsed_ms / 1000.0:.1f} s"
+        elif self.exhausted == "attempts":
+            head = f"Attempt budget ran out after {self.attempts:,} attempts"
+        return f"{head}: {'; '.join(parts)}."
+
+
+# =========================================================
+# GENERATION PLAN (compiled once per balance, reused across clicks)
+# =========================================================
+GENERATION_PLAN_CACHE_SIZE = 16
+
+
+def _balance_cache_key(chord_balance: Optional[Dict[str, int]]):
+    if not chord_balance:
+        return None
+    return tuple(sorted((q, int(v)) for q, v in chord_balance.items()))
+
+
+class GenerationPlan:
+    """
+    Every weighted table generate_progressions draws from, for one chord balance:
+    (total,m) combos, templates, durations and per-(key, degree) quality pools.
+    """
+    __slots__ = ("chord_balance", "combos", "templates", "durations", "deg_pools",
+                 "sus_heavy", "sus_start_ok", "sus_caps", "_exact", "_sus_relaxed")
+
+    def __init__(self, chord_balance: Optional[Dict[str, int]]):
+        self.chord_balance = chord_balance
+        self.combos = WeightedTable(_valid_total_and_m_weights())
+        self.templates = {m: WeightedTable(t) for m, t in TEMPLATES_BY_LEN.items()}
+        self.durations = {c: WeightedTable(d) for c, d in DURATIONS.items()}
+        self.deg_pools = {
+            key: {deg: WeightedTable(items) for deg, items in _build_deg_allowed(chord_balance, key).items()}
+            for key in KEYS
+        }
+        self.sus_heavy = _is_sus_heavy(chord_balance)
+        self.sus_start_ok = _sus_start_allowed(chord_balance)
+        self.sus_caps = (DEFAULT_SUS_MAX_RATIO, DEFAULT_SUS4_MAX_COUNT)
+        self._exact = None
+        self._sus_relaxed = None
+
+    def exact_space(self) -> dict:
+        if self._exact is None:
+            self._exact = _build_exact_space(self)
+        return self._exact
+
+    def sus_relaxed(self) -> "GenerationPlan":
+        """The same tables with sus starts allowed and the RELAXED_SUS_* caps (built once)."""
+        if self._sus_relaxed is None:
+            relaxed = object.__new__(GenerationPlan)
+            for name in ("chord_balance", "combos", "templates", "durations", "deg_pools", "sus_heavy"):
+                setattr(relaxed, name, getattr(self, name))
+            relaxed.sus_start_ok = True
+            relaxed.sus_caps = (RELAXED_SUS_MAX_RATIO, RELAXED_SUS4_MAX_COUNT)
+            relaxed._exact = None
+            relaxed._sus_relaxed = relaxed
+            self._sus_relaxed = relaxed
+        return self._sus_relaxed
+
+
+@lru_cache(maxsize=GENERATION_PLAN_CACHE_SIZE)
+def _generation_plan_cached(balance_key) -> GenerationPlan:
+    return GenerationPlan(dict(balance_key) if balance_key is not None else None)
+
+
+def get_generation_plan(chord_balance: Optional[Dict[str, int]]) -> GenerationPlan:
+    return _generation_plan_cached(_balance_cache_key(chord_balance))
+
+
+# =========================================================
+# EXACT SAMPLER (enumerate the legal space once, then bisect)
+# =========================================================
+# Every key in SCALES is a major scale, so legality of a (degs, quals) shape
+# is the same in all 12 keys. The space is enumerated once in EXACT_SPACE_KEY
+# and spelled into the target key when sampled.
+# Stricter than the rejection sampler: it holds only shapes that pass as
+# drawn, with the balance's enabled qualities. The rejection sampler also
+# keeps shapes that _dedupe_inside_progression repaired, which may swap in
+# any SAFE_FALLBACK_ORDER quality or a neighbouring degree, so on tight
+# balances it can build packs the exact space is too small for.
+SAMPLER_MODES = ("rejection", "exact")
+EXACT_SPACE_KEY = "C"
+
+
+def _enumerate_template_quals(
+    degs: tuple,
+    pools: Dict[int, List[Tuple[str, float, int]]],
+    succ: Dict[Tuple[int, str], set],
+    sus_heavy: bool,
+    sus_start_ok: bool,
+    sus_caps: Tuple[float, int] = (DEFAULT_SUS_MAX_RATIO, DEFAULT_SUS4_MAX_COUNT),
+) -> List[Tuple[tuple, float]]:
+    """
+    All quality assignments for one template that pass _progression_rule_failure
+    and the low-sim check without needing dedupe. Mirrors those rules incrementally
+    so dead prefixes are cut as soon as they break a pair/count limit.
+    """
+    m = len(degs)
+    root_pcs = [_pc(SCALES[EXACT_SPACE_KEY][d]) for d in degs]
+    step_moves = sum(1 for i in range(m) if _pc_interval(root_pcs[i], root_pcs[(i + 1) % m]) <= 2)
+    has_repeat_root = len(set(root_pcs)) < m
+    if sus_heavy and HEAVY_REQUIRE_STEP_OR_REPEAT and step_moves == 0 and not has_repeat_root:
+        return []
+
+    max_big = MAX_BIG_JUMPS_PER_PROG if LIMIT_NOTECOUNT_JUMPS else m + 1
+
+    out: List[Tuple[tuple, float]] = []
+    path: List[Tuple[int, str]] = []
+
+    def walk(i: int, w: float, sus_n: int, sus4_n: int, big_n: int):
+        if i == m:
+            first, last = path[0], path[-1]
+            if first not in succ[last]:
+                return
+            if ENFORCE_LOOP_OK and m >= 2:
+                if abs(QUALITY_NOTECOUNT[last[1]] - QUALITY_NOTECOUNT[first[1]]) >= 3:
+                    big_n += 1
+            if big_n > max_big:
+                return
+            out.append((tuple(q for _, q in path), w))
+            return
+
+        d = degs[i]
+        for q, qw, _mask in pools[d]:
+            node = (d, q)
+            if node in path:
+                continue
+            if i == 0:
+                if _is_sus(q) and not sus_start_ok:
+                    continue
+                big2 = big_n
+            else:
+                if node not in succ[path[-1]]:
+                    continue
+                big2 = big_n + (abs(QUALITY_NOTECOUNT[path[-1][1]] - QUALITY_NOTECOUNT[q]) >= 3)
+                if big2 > max_big:
+                    continue
+
+            sus2 = sus_n + _is_sus(q)
+            sus42 = sus4_n + _is_sus4ish(q)
+            if not sus_heavy:
+                if sus2 / max(1, m) > sus_caps[0] or sus42 > sus_caps[1]:
+                    continue
+
+            path.append(node)
+            walk(i + 1, w * qw, sus2, sus42, big2)
+            path.pop()
+
+    walk(0, 1.0, 0, 0, 0)
+    return out
+
+
+def _build_exact_space(plan: GenerationPlan) -> dict:
+    """
+    Weighted table of every legal (degs, quals) shape for the plan's balance
+    that needs no dedupe repair (see EXACT SAMPLER).
+    Weights match the rejection sampler's draw probabilities for those shapes:
+    (total,m) combo x template x per-degree quality weights.
+    """
+    key = EXACT_SPACE_KEY
+    deg_allowed = _build_deg_allowed(plan.chord_balance, key)
+    sus_heavy = plan.sus_heavy
+
+    pools: Dict[int, List[Tuple[str, float, int]]] = {}
+    for deg, items in deg_allowed.items():
+        tot = sum(w for _, w in items)
+        root_pc = _pc(SCALES[key][deg])
+        pools[deg] = [(q, w / tot, CHORD_PC_MASK[(root_pc, q)]) for q, w in items]
+
+    # (deg, qual) -> every (deg, qual) it may move to (shared tones + sus rules)
+    succ: Dict[Tuple[int, str], set] = {}
+    for da, pa in pools.items():
+        pc_a = _pc(SCALES[key][da])
+        for qa, _, mask_a in pa:
+            nxt = set()
+            for db, pb in pools.items():
+                pc_b = _pc(SCALES[key][db])
+                for qb, _, mask_b in pb:
+                    if (_shared_tones(mask_a, mask_b) >= MIN_SHARED_TONES
+                            and _transition_ok(qa, qb, mask_a, mask_b, pc_a, pc_b, sus_heavy)):
+                        nxt.add((db, qb))
+            succ[(da, qa)] = nxt
+
+    by_m: Dict[int, WeightedTable] = {}
+    m_mass: Dict[int, float] = {}
+    for m, templates in TEMPLATES_BY_LEN.items():
+        t_total = sum(w for _, w in templates)
+        entries: List[Tuple[Tuple[tuple, tuple], float]] = []
+        for degs, tw in templates:
+            if tw <= 0 or any(not pools[d] for d in degs):
+                continue
+            for quals, qw in _enumerate_template_quals(degs, pools, succ, sus_heavy, plan.sus_start_ok, plan.sus_caps):
+                entries.append(((degs, quals), (tw / t_total) * qw))
+        by_m[m] = WeightedTable(entries)
+        m_mass[m] = by_m[m].total
+
+    combos = []
+    for (total, m), wt in _valid_total_and_m_weights():
+        wt *= m_mass.get(m, 0.0)
+        if wt > 0:
+            combos.append(((total, m), wt))
+
+    size = sum(len(by_m[m]) for m in {m for (_, m), _ in combos})
+    return {"combos": WeightedTable(combos), "by_m": by_m, "size": size}
+
+
+def _sample_exact(rng: random.Random, plan: GenerationPlan, space: dict, key: str):
+    total_bars, m = space["combos"].draw(rng)
+    degs, quals = space["by_m"][m].draw(rng)
+    deg_pc = KEY_DEGREE_PC[key]
+    ids = bytes(chord_id(deg_pc[d], q) for d, q in zip(degs, quals))
+    durs = plan.durations[(m, total_bars)].draw(rng)
+    return ids, durs, key, list(degs), list(quals)
+
+
+def _check_exact_capacity(space: dict, keys: list, max_pattern_dupes: int):
+    """
+    Fail fast when the request cannot fit in the exact space:
+    exact chords must be unique per key, and each shape may only repeat
+    across keys within the pattern-duplicate allowance.
+    """
+    size = space["size"]
+    if size == 0:
+        raise RuntimeError("No legal progressions exist for the current chord-type balance.")
+    n = len(keys)
+    if n > size + max_pattern_dupes:
+        raise RuntimeError(
+            f"The exact sampler only has {size} distinct progression shapes for the current "
+            f"chord-type balance (+{max_pattern_dupes} allowed repeats); {n} were requested. "
+            "It only uses the enabled chord types; the default sampler can substitute "
+            "others to avoid repeated chords and may fit more."
+        )
+
+
+def _draw_candidate(
+    rng: random.Random,
+    plan: GenerationPlan,
+    space: Optional[dict],
+    key: str,
+    bans: Optional[Container],
+    stats: Optional[GenerationStats] = None,
+):
+    """
+    One attempt: a rule-passing, non-banned progression in `key`, or None.
+    bans: BanIndex.lookup() of the run's ban set.
+    Result: (chord ID bytes, durations, key, degrees, qualities).
+    """
+    if stats is not None:
+        stats.attempts += 1
+    if space is not None:
+        res = _sample_exact(rng, plan, space, key)
+    else:
+        total_bars, m = plan.combos.draw(rng)
+        degs = plan.templates[m].draw(rng)
+        res = _build_progression(rng, plan, key, degs, total_bars, stats)
+    if res is None:
+        return None
+    if bans is not None and res[0] in bans:
+        return _rejected(stats, "banned")
+    return res
+
+
+# =========================================================
+# WORKER POOLS
+# =========================================================
+def _fork_allowed() -> bool:
+    """
+    fork only from the main thread. A fork made from any other thread (the
+    Streamlit server runs each script on one) copies locks that its other
+    threads may hold, and the child can deadlock on them.
+    """
+    return "fork" in mp.get_all_start_methods() and threading.current_thread() is threading.main_thread()
+
+
+def _run_jobs(fn, jobs: list, workers: int, kind: str = "process") -> list:
+    """
+    Ordered map of fn over jobs.
+    Processes use fork so workers inherit the loaded engine (and any tables
+    warmed before the call). Without fork, jobs run in-process.
+    """
+    if workers <= 1 or len(jobs) <= 1:
+        return [fn(job) for job in jobs]
+
+    if kind == "thread":
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(fn, jobs))
+
+    if not _fork_allowed():
+        return [fn(job) for job in jobs]
+
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("fork")) as pool:
+        return list(pool.map(fn, jobs, chunksize=chunksize))
+
+
+# =========================================================
+# PARALLEL GENERATION (per-progression seed streams + ordered merge)
+# =========================================================
+# Each progression index i gets its own RNG seeded from (seed, i). Workers
+# draw each index's first valid candidate; the merge walks indices in order
+# and enforces the pack-wide exact/pattern limits. If a candidate clashes
+# with an earlier pick, the merge replays that index's stream in-process,
+# skips the draws the worker already counted, and keeps drawing (a replay
+# yields the same candidates, so output and stats match any worker count).
+# Small runs, budgeted runs and calls off the main thread draw the same
+# streams in-process. The result only depends on (seed, n, balance, banlist),
+# never on the worker count.
+GENERATION_WORKERS = 0              # 0 = single RNG stream (legacy seeds), N = per-progression seeds on N processes
+# Below this the pool loses: forking 2/4/8 workers costs ~16/30/50 ms, the
+# shards only take ~0.1 ms per index off the main process, and 10-30% of
+# indices are replayed in the merge (default balance, break-even ~1000).
+PARALLEL_MIN_N = 1_000
+PARALLEL_SHARDS_PER_WORKER = 4
+
+
+def _progression_seed(seed: int, index: int) -> int:
+    h = hashlib.blake2b(f"{seed}:{index}".encode("utf-8"), digest_size=8)
+    return int.from_bytes(h.digest(), "big")
+
+
+def _generate_candidate_shard(job):
+    seed, indices, keys, chord_balance, sampler, ban_set, collect = job
+    plan = get_generation_plan(chord_balance)
+    space = plan.exact_space() if sampler == "exact" else None
+    stats = GenerationStats() if collect else None
+    bans = ban_set.lookup()
+
+    out = []
+    for i, key in zip(indices, keys):
+        rng = random.Random(_progression_seed(seed, i))
+        res = None
+        tries = 0
+        while res is None and tries < MAX_TRIES_PER_PROG:
+            tries += 1
+            res = _draw_candidate(rng, plan, space, key, bans, stats)
+        out.append((res, tries))
+    # worker-side counters travel back with the shard
+    return out, (None if stats is None else (stats.attempts, stats.rejections))
+
+
+def _parallel_candidates(
+    seed: int,
+    keys: list,
+    chord_balance: Optional[Dict[str, int]],
+    sampler: str,
+    ban_set: BanIndex,
+    workers: int,
+    stats: Optional[GenerationStats] = None,
+) -> list:
+    n = len(keys)
+    shard_count = max(1, min(n, workers * PARALLEL_SHARDS_PER_WORKER))
+    step = int(math.ceil(n / shard_count)) if n else 1
+    jobs = [
+        (seed, list(range(lo, min(n, lo + step))), keys[lo:lo + step], chord_balance, sampler, ban_set,
+         stats is not None)
+        for lo in range(0, n, step)
+    ]
+
+    shards = _run_jobs(_generate_candidate_shard, jobs, workers)
+    if stats is not None:
+        for _, (attempts, rejections) in shards:
+            stats.attempts += attempts
+            stats.rejections.update(rejections)
+    return [item for items, _ in shards for item in items]
+
+
+class ProgressionStream:
+    """
+    Iterator over accepted progressions, (chords, durations, key), in the order
+    generate_progressions would return them. The tallies are final once it is
+    exhausted.
+    """
+    __slots__ = ("pattern_dupe_used", "max_pattern_dupes", "low_sim_total", "qual_usage",
+                 "_gen", "_stats", "_budget")
+
+    def __init__(self, gen, max_pattern_dupes: int, stats: Optional[GenerationStats], budget: Optional[GenerationBudget]):
+        self.pattern_dupe_used = 0
+        self.max_pattern_dupes = max_pattern_dupes
+        self.low_sim_total = 0
+        self.qual_usage: Counter = Counter()
+        self._gen = gen
+        self._stats = stats
+        self._budget = budget
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> tuple:
+        t0 = time.perf_counter()
+        if self._budget is not None:
+            self._budget.resume()
+        try:
+            return next(self._gen)
+        except StopIteration as stop:
+            if stop.value is not None:
+                self.pattern_dupe_used, self.max_pattern_dupes, self.low_sim_total, self.qual_usage = stop.value
+            raise
+        finally:
+            # only the generator's own time; the consumer's work between items is not charged
+            if self._stats is not None:
+                self._stats.add_time("generate", t0)
+            if self._budget is not None:
+                self._budget.pause()
+
+
+def iter_progressions(
+    n: int,
+    seed: int,
+    chord_balance: Optional[Dict[str, int]] = None,
+    ban_set: Optional[BanIndex] = None,
+    sampler: str = "rejection",
+    workers: int = 0,
+    stats: Optional[GenerationStats] = None,
+    budget: Optional[GenerationBudget] = None,
+) -> ProgressionStream:
+    """
+    Streaming generate_progressions: yields each progression as it is accepted.
+    With workers=0 the first one arrives after a handful of attempts whatever n
+    is; with workers>=2 and n >= PARALLEL_MIN_N the pool draws a candidate for
+    every index before the first item (unless a budget is given).
+    A budget's clock only runs inside the stream: the consumer's time between
+    items (rendering, UI updates) is not charged against its deadline.
+    """
+    if sampler not in SAMPLER_MODES:
+        raise ValueError(f"Unknown sampler '{sampler}'.")
+    ban_set = _as_ban_index(ban_set)
+    if budget is not None:
+        budget.start(n)
+    gen = _iter_progressions(n, seed, chord_balance, ban_set, sampler, workers, stats, budget)
+    return ProgressionStream(gen, int(math.floor(n * MAX_PATTERN_DUPLICATE_RATIO)), stats, budget)
+
+
+def generate_progressions(
+    n: int,
+    seed: int,
+    chord_balance: Optional[Dict[str, int]] = None,
+    ban_set: Optional[BanIndex] = None,
+    sampler: str = "rejection",
+    workers: int = 0,
+    stats: Optional[GenerationStats] = None,
+    budget: Optional[GenerationBudget] = None,
+):
+    """
+    workers=0 keeps the single seeded RNG stream (legacy output per seed).
+    workers>=1 switches to per-progression seed streams; output for a seed is
+    the same for any worker count.
+    stats: optional GenerationStats, filled in place (also on failure).
+    budget: optional GenerationBudget; bounds the call and may relax rules or
+    return fewer than n progressions (see GENERATION BUDGET).
+    """
+    stream = iter_progressions(n, seed, chord_balance, ban_set, sampler, workers, stats, budget)
+    out = list(stream)
+    return out, stream.pattern_dupe_used, stream.max_pattern_dupes, stream.low_sim_total, stream.qual_usage
+
+
+def _iter_progressions(n, seed, chord_balance, ban_set, sampler, workers, stats, budget):
+    rng = random.Random(seed)
+    keys = _pick_keys_even(n, rng)
+
+    max_pattern_dupes = int(math.floor(n * MAX_PATTERN_DUPLICATE_RATIO))
+    pattern_dupe_used = 0
+
+    plan = get_generation_plan(chord_balance)
+    space = None
+    if sampler == "exact":
+        space = plan.exact_space()
+        _check_exact_capacity(space, keys, max_pattern_dupes)
+
+    used_exact = set()
+    pattern_counts = Counter()
+    low_sim_total = 0
+    qual_usage = Counter()
+    allow_pattern_dupes = False
+    bans = ban_set.lookup()
+
+    built_count = 0
+
+    def accept(res) -> Optional[tuple]:
+        nonlocal pattern_dupe_used, low_sim_total
+        ids, durs, key, degs_used, quals_used = res
+
+        ek = ids
+        if ek in used_exact:
+            return _rejected(stats, "exact_duplicate")
+
+        fp = _pattern_fingerprint(degs_used, quals_used)
+        if (pattern_counts[fp] >= PATTERN_MAX_REPEATS and pattern_dupe_used >= max_pattern_dupes
+                and not allow_pattern_dupes):
+            return _rejected(stats, "pattern_limit")
+
+        used_exact.add(ek)
+        if pattern_counts[fp] >= 1:
+            pattern_dupe_used += 1
+        pattern_counts[fp] += 1
+
+        roots = [SCALES[key][d] for d in degs_used]
+        low_sim_total += _low_sim_count_loop(roots, quals_used, loop=ENFORCE_LOOP_OK)
+        for q in quals_used:
+            qual_usage[q] += 1
+        if stats is not None:
+            stats.accepted += 1
+
+        return (chord_names(ids, key), durs, key)
+
+    def draw_slot(draw_rng: random.Random, key: str, tries: int) -> Optional[tuple]:
+        """Draw until one is accepted; with a budget, walk down the ladder when the slot stalls."""
+        nonlocal plan, space, allow_pattern_dupes
+        while True:
+            limit = MAX_TRIES_PER_PROG if budget is None else budget.try_limit()
+            while tries < limit:
+                tries += 1
+                if budget is not None:
+                    if not budget.spend():
+                        return None
+                    if budget.behind_schedule():
+                        break
+                res = _draw_candidate(draw_rng, plan, space, key, bans, stats)
+                if res is None:
+                    continue
+                built = accept(res)
+                if built is not None:
+                    return built
+            rung = None if budget is None else budget.next_rung()
+            if rung is None:
+                return None
+            if rung == RELAX_PATTERN_DUPES:
+                allow_pattern_dupes = True
+            elif rung == RELAX_SUS_SAFETY:
+                plan = plan.sus_relaxed()
+                if space is not None:
+                    space = plan.exact_space()
+            tries = 0
+
+    def keep_going(i: int) -> bool:
+        """Slot i came up empty: skip it (True), stop with a partial result (False), or raise."""
+        if budget is None or RELAX_FEWER not in budget.ladder:
+            if budget is not None and budget.exhausted is not None:
+                raise RuntimeError(
+                    f"Generation budget ran out ({budget.exhausted}) after {built_count} of {n} progressions."
+                )
+            raise RuntimeError(f"Could not build progression {i+1}. Space too constrained.")
+        if RELAX_FEWER not in budget.relaxed:
+            budget.relaxed.append(RELAX_FEWER)
+        return budget.exhausted is None
+
+    def keep():
+        nonlocal built_count
+        built_count += 1
+        if budget is not None:
+            budget.built += 1
+
+    if workers <= 1 or budget is not None or n < PARALLEL_MIN_N or not _fork_allowed():
+        # in-process; a budget must charge every attempt and may relax between them
+        for i in range(n):
+            draw_rng = rng if workers <= 0 else random.Random(_progression_seed(seed, i))
+            built = draw_slot(draw_rng, keys[i], 0)
+            if built is not None:
+                keep()
+                yield built
+            elif not keep_going(i):
+                break
+
+    else:
+        streams = _parallel_candidates(seed, keys, chord_balance, sampler, ban_set, workers, stats)
+        for i, (res, tries) in enumerate(streams):
+            built = None if res is None else accept(res)
+            if built is None and res is not None:
+                # taken by an earlier index: replay this index's stream past the worker's
+                # draws (already counted in stats) and keep drawing
+                local = random.Random(_progression_seed(seed, i))
+                for _ in range(tries):
+                    _draw_candidate(local, plan, space, keys[i], bans)
+                built = draw_slot(local, keys[i], tries)
+
+            if built is not None:
+                keep()
+                yield built
+            elif not keep_going(i):
+                break
+
+    if n and not built_count:
+        raise RuntimeError("No progressions could be built within the generation budget.")
+
+    return pattern_dupe_used, max_pattern_dupes, low_sim_total, qual_usage
+
+
+# =========================================================
+# CHORD -> MIDI + VOICING ENGINE (HARD-SAFE, NO SUB-FLOOR)
+# (PATCH: DEFAULT = VOICE-LED TIGHT, + WIDE + LOW MODES)
+# =========================================================
+
+NOTE_TO_SEMITONE = NOTE_TO_PC.copy()
+
+# -------------------------
+# HARD GLOBAL PITCH LIMITS
+# -------------------------
+ABS_NOTE_FLOOR = 40
+ABS_NOTE_CEIL  = 88
+
+BASS_PREF_MIN = 40
+BASS_PREF_MAX = 52
+
+BASS_HARD_MIN = ABS_NOTE_FLOOR
+BASS_HARD_MAX = 60
+
+MAX_BASS_JUMP = 7
+
+TARGET_CENTER = 60.0
+
+IDEAL_SPAN = 12
+MIN_SPAN   = 8
+MAX_SPAN   = 18
+
+MIN_ADJ_GAP = 2
+MAX_ADJ_GAP = 9
+HARD_MAX_ADJ_GAP = 12
+
+MAX_SHARED_DEFAULT = 3
+MAX_SHARED_MIN11   = 4
+
+ENFORCE_NOT_RAW_WHEN_VOICING = True
+RAW_PENALTY = 1200
+
+GLUE_LOW_CUTOFF  = 44
+GLUE_PROBABILITY = 0.35
+
+ALLOW_RESOLVE_TO_THIRD = True
+ALLOW_RESOLVE_TO_FIFTH = False
+
+
+# -------------------------
+# NEW: VOICING MODES
+# -------------------------
+# Default is the new "tight voice-leading melt" behavior.
+VOICING_MODE = "default"  # "default" | "wide" | "low"
+
+# A profile is just weights + range targets for scoring.
+# Movement dominates in default/low, less so in wide.
+VOICING_PROFILES = {
+    "default": dict(
+        lo=48, hi=76,
+        target_center=60.0,
+        ideal_span=12, min_span=8, max_span=18,
+        w_move=220.0,         # BIG: minimize total motion hard
+        w_leap=260.0,         # punish big single-voice jumps
+        w_center=70.0,        # mild register pull
+        w_span=55.0,          # keep compact
+        w_top=35.0,           # avoid too-bright top
+        w_shared_bonus=180.0  # reward shared pitch classes
+    ),
+    "wide": dict(
+        lo=48, hi=88,
+        target_center=66.0,
+        ideal_span=18, min_span=10, max_span=28,
+        w_move=95.0,          # less strict motion
+        w_leap=120.0,
+        w_center=55.0,
+        w_span=25.0,          # allow wider
+        w_top=10.0,           # allow brighter top
+        w_shared_bonus=70.0
+    ),
+    "low": dict(
+        lo=40, hi=72,
+        target_center=54.0,
+        ideal_span=12, min_span=8, max_span=18,
+        w_move=240.0,         # same melt, even stricter
+        w_leap=300.0,
+        w_center=120.0,       # strong pull lower
+        w_span=60.0,
+        w_top=110.0,          # strong anti-brightness
+        w_shared_bonus=200.0
+    ),
+}
+
+
+def parse_root_and_bass(ch: str):
+    ch = ch.strip().replace("6/9", "6add9")
+    if "/" in ch:
+        main, bass = ch.split("/", 1)
+        bass = bass.strip()
+    else:
+        main, bass = ch, None
+
+    main = main.strip()
+    m = re.match(r"^([A-G](?:#|b)?)(.*)$", main)
+    if not m:
+        raise ValueError(f"Bad chord root in '{ch}'")
+
+    root = m.group(1)
+    rest = m.group(2).strip().replace(" ", "")
+    return root, rest, bass
+
+
+def _force_into_range_by_octaves(p: int, lo: int, hi: int) -> int:
+    while p < lo:
+        p += 12
+    while p > hi:
+        p -= 12
+    return int(p)
+
+
+def _sanitize_notes_strict(notes: List[int]) -> List[int]:
+    v = [int(x) for x in notes]
+    out = []
+    used = set()
+    for p in sorted(v):
+        p = _force_into_range_by_octaves(p, ABS_NOTE_FLOOR, ABS_NOTE_CEIL)
+
+        while p in used and (p + 12) <= ABS_NOTE_CEIL:
+            p += 12
+        while p in used and (p - 12) >= ABS_NOTE_FLOOR:
+            p -= 12
+
+        used.add(p)
+        out.append(p)
+
+    out = sorted(out)
+
+    if out and min(out) < ABS_NOTE_FLOOR:
+        shift = 0
+        while min(out) + shift < ABS_NOTE_FLOOR:
+            shift += 12
+        out = [p + shift for p in out]
+        out = [min(p, ABS_NOTE_CEIL) for p in out]
+        out = sorted(set(out))
+        out = sorted([_force_into_range_by_octaves(p, ABS_NOTE_FLOOR, ABS_NOTE_CEIL) for p in out])
+
+    return out
+
+
+def _prefer_bass_zone(notes: List[int]) -> List[int]:
+    if not notes:
+        return notes
+
+    v = sorted(notes)
+    pref_center = (BASS_PREF_MIN + BASS_PREF_MAX) / 2.0
+    options = []
+    for k in range(-4, 5):
+        vv = [p + 12 * k for p in v]
+        if min(vv) < ABS_NOTE_FLOOR or max(vv) > ABS_NOTE_CEIL:
+            continue
+        bb = min(vv)
+        if bb < BASS_HARD_MIN or bb > BASS_HARD_MAX:
+            continue
+
+        dist = 0.0
+        if bb < BASS_PREF_MIN:
+            dist += (BASS_PREF_MIN - bb) * 25.0
+        elif bb > BASS_PREF_MAX:
+            dist += (bb - BASS_PREF_MAX) * 25.0
+        dist += abs(bb - pref_center) * 2.0
+        options.append((dist, vv))
+
+    if options:
+        options.sort(key=lambda x: x[0])
+        v = options[0][1]
+
+    return _sanitize_notes_strict(v)
+
+
+def chord_to_midi(chord_name: str, base_oct=3) -> List[int]:
+    root, rest, bass = parse_root_and_bass(chord_name)
+
+    if root not in NOTE_TO_SEMITONE:
+        raise ValueError(f"Bad root '{root}' in '{chord_name}'")
+
+    quality = rest.lower()
+    if quality not in QUAL_TO_INTERVALS:
+        raise ValueError(f"Unrecognized chord quality: {rest}")
+
+    root_pc = NOTE_TO_SEMITONE[root]
+    root_midi = 12 * (base_oct + 1) + root_pc
+
+    tones = QUAL_TO_INTERVALS[quality]
+    notes = [root_midi + iv for iv in tones]
+
+    if bass:
+        if bass not in NOTE_TO_SEMITONE:
+            raise ValueError(f"Bad slash bass '{bass}' in '{chord_name}'")
+        bass_pc = NOTE_TO_SEMITONE[bass]
+        bass_midi = 12 * (base_oct + 1) + bass_pc
+        notes = [bass_midi] + notes
+
+    notes = _sanitize_notes_strict(notes)
+    notes = _prefer_bass_zone(notes)
+    return notes
+
+
+# -------------------------
+# Pitch masks: a voicing as one int (bit n = MIDI note n, 0..127) plus a
+# 12-bit pitch-class fold. Voicings never repeat a pitch, so set logic on
+# notes is bit logic on masks; lists are rebuilt only where order matters.
+# -------------------------
+PC_FOLD_BITS = (1 << 12) - 1
+
+
+def _pitch_mask(notes) -> int:
+    m = 0
+    for n in notes:
+        m |= 1 << int(n)
+    return m
+
+
+def _mask_notes(mask: int) -> List[int]:
+    """Ascending MIDI notes of a pitch mask."""
+    out = []
+    while mask:
+        low = mask & -mask
+        out.append(low.bit_length() - 1)
+        mask ^= low
+    return out
+
+
+def _mask_lo(mask: int) -> int:
+    return (mask & -mask).bit_length() - 1
+
+
+def _mask_hi(mask: int) -> int:
+    return mask.bit_length() - 1
+
+
+def _pc_fold(mask: int) -> int:
+    """Pitch mask -> 12-bit pitch-class mask."""
+    pcs = 0
+    while mask:
+        pcs |= mask & PC_FOLD_BITS
+        mask >>= 12
+    return pcs
+
+
+def _pc_rotate(pc_mask: int, d: int) -> int:
+    """Transpose a 12-bit pitch-class mask by d semitones."""
+    d %= 12
+    return ((pc_mask << d) | (pc_mask >> (12 - d))) & PC_FOLD_BITS
+
+
+@lru_cache(maxsize=64)
+def _octaves_mask(pc_mask: int) -> int:
+    """Every MIDI pitch 0..127 whose pitch class is in pc_mask."""
+    m = 0
+    for octave in range(0, 128, 12):
+        m |= pc_mask << octave
+    return m & ((1 << 128) - 1)
+
+
+def _semitone_neighbours(mask: int) -> int:
+    return (mask << 1) | (mask >> 1)
+
+
+@lru_cache(maxsize=None)
+def chord_id_notes(cid: int) -> Tuple[int, ...]:
+    """Register-locked raw notes of a chord ID."""
+    return tuple(_enforce_register(chord_to_midi(chord_name(cid))))
+
+
+def raw_chord_notes(chord: str) -> List[int]:
+    """Register-locked raw notes; vocabulary chords come from the ID table, anything else is parsed."""
+    cid = CHORD_ID_BY_NAME.get(chord)
+    if cid is not None:
+        return list(chord_id_notes(cid))
+    return _enforce_register(chord_to_midi(chord))
+
+
+def span(notes: List[int]) -> int:
+    return int(max(notes) - min(notes)) if notes else 0
+
+
+def center(notes: List[int]) -> float:
+    return (min(notes) + max(notes)) / 2.0 if notes else TARGET_CENTER
+
+
+def semitone_pairs(notes: List[int]):
+    m = _pitch_mask(notes)
+    return [(a, a + 1) for a in _mask_notes(m & (m >> 1))]
+
+
+def glue_ok(notes: List[int], rng: random.Random) -> bool:
+    pairs = semitone_pairs(notes)
+    if not pairs:
+        return True
+    for a, b in pairs:
+        if a < GLUE_LOW_CUTOFF or b < GLUE_LOW_CUTOFF:
+            return False
+    return rng.random() < GLUE_PROBABILITY
+
+
+def is_min11_name(ch_name: str) -> bool:
+    return ("min11" in ch_name.replace(" ", "").lower())
+
+
+def max_shared_allowed(prev_name: str, cur_name: str) -> int:
+    return MAX_SHARED_MIN11 if (is_min11_name(prev_name) or is_min11_name(cur_name)) else MAX_SHARED_DEFAULT
+
+
+def max_shared_allowed_ids(prev_id: int, cur_id: int) -> int:
+    return MAX_SHARED_MIN11 if "min11" in (CHORD_ID_QUAL[prev_id], CHORD_ID_QUAL[cur_id]) else MAX_SHARED_DEFAULT
+
+
+def _shared_limits(chords, ids: Optional[bytes]) -> List[int]:
+    """max_shared_allowed for every chord -> next chord (wrapping), from IDs when available."""
+    n = len(chords)
+    if ids is not None:
+        return [max_shared_allowed_ids(ids[i], ids[(i + 1) % n]) for i in range(n)]
+    return [max_shared_allowed(chords[i], chords[(i + 1) % n]) for i in range(n)]
+
+
+def allowed_resolution_pcs(key: str) -> set:
+    pcs = set()
+    tonic = NOTE_TO_PC[SCALES[key][0]]
+    pcs.add(tonic)
+
+    if ALLOW_RESOLVE_TO_THIRD:
+        third = NOTE_TO_PC[SCALES[key][2]]
+        pcs.add(third)
+
+    if ALLOW_RESOLVE_TO_FIFTH:
+        fifth = NOTE_TO_PC[SCALES[key][4]]
+        pcs.add(fifth)
+
+    return pcs
+
+
+def _cross_semitone_targets(prev_notes: List[int], allowed_target_pcs: set) -> int:
+    """Pitch mask of notes that would sit a semitone from prev_notes without resolving."""
+    allowed = _octaves_mask(_pcs_to_mask(allowed_target_pcs))
+    return _semitone_neighbours(_pitch_mask(prev_notes)) & ~allowed
+
+
+def repair_cross_semitones(prev_notes: List[int], cur_notes: List[int], allowed_target_pcs: set, max_iters: int = 8) -> List[int]:
+    return _repair_cross_semitones_mask(_cross_semitone_targets(prev_notes, allowed_target_pcs), cur_notes, max_iters)
+
+
+def _repair_cross_semitones_mask(bad: int, cur_notes: List[int], max_iters: int = 8) -> List[int]:
+    """
+    repair_cross_semitones with the offending pitches precomputed as a mask
+    (see _cross_semitone_targets). Each option is scored on its mask; only
+    the winner is turned back into a note list.
+    """
+    v = sorted(list(cur_notes))
+    vm = _pitch_mask(v)
+    bass_mid = (BASS_PREF_MIN + BASS_PREF_MAX) / 2.0
+    for _ in range(max_iters):
+        if not (vm & bad):
+            break
+        bad_idxs = [i for i, n in enumerate(v) if (bad >> n) & 1]
+
+        changed_any = False
+        for idx in bad_idxs:
+            n = v[idx]
+            best = None
+            for delta in (+12, -12):
+                n2 = n + delta
+                if n2 < ABS_NOTE_FLOOR or n2 > ABS_NOTE_CEIL:
+                    continue
+                if (vm >> n2) & 1:
+                    continue
+                tm = (vm & ~(1 << n)) | (1 << n2)
+                lo, hi = _mask_lo(tm), _mask_hi(tm)
+                score = ((tm & bad).bit_count(), abs((lo + hi) / 2.0 - TARGET_CENTER), hi - lo, abs(lo - bass_mid))
+                if best is None or score < best[0]:
+                    best = (score, tm)
+            if best is not None:
+                vm = best[1]
+                v = _mask_notes(vm)
+                changed_any = True
+
+        if not changed_any:
+            break
+
+    return _sanitize_notes_strict(v)
+
+
+def _min_assignment_move(prev: List[int], cur: List[int]) -> float:
+    # Stable matching: sort both. (Permutation solver is expensive and overkill here.)
+    p = sorted(prev)
+    c = sorted(cur)
+    if not p or not c:
+        return 0.0
+    m = min(len(p), len(c))
+    return float(sum(abs(c[i] - p[i]) for i in range(m)))
+
+
+def generate_voicing_candidates(raw_notes: List[int], mode: str, extended: bool = False) -> List[List[int]]:
+    """
+    Generates candidates and lets the scoring decide.
+    Still:
+    - never below ABS_NOTE_FLOOR
+    - never above ABS_NOTE_CEIL
+    - bass must remain inside hard clamp
+    extended=True adds every inversion at every octave, all spread depths and
+    drop-2 shapes (used by the whole-progression optimizer).
+    """
+    prof = VOICING_PROFILES.get(mode, VOICING_PROFILES["default"])
+
+    base = _sanitize_notes_strict(raw_notes)
+    n = len(base)
+    if n == 0:
+        return []
+
+    candidates = set()
+
+    def add(v):
+        v = _sanitize_notes_strict(v)
+        if len(v) != n:
+            return
+        b = min(v)
+        if b < BASS_HARD_MIN or b > BASS_HARD_MAX:
+            return
+        if min(v) < ABS_NOTE_FLOOR or max(v) > ABS_NOTE_CEIL:
+            return
+        candidates.add(tuple(sorted(v)))
+
+    # Start from base, register into bass zone
+    add(_prefer_bass_zone(base))
+
+    # Inversions + octave placement
+    inv = base[:]
+    for _ in range(n - 1):
+        inv = inv[1:] + [inv[0] + 12]
+        add(_prefer_bass_zone(inv))
+
+    # Whole chord octave shifts (more options for wide/low via profile range)
+    for shift in (-24, -12, 0, 12, 24):
+        v = [x + shift for x in base]
+        v = _sanitize_notes_strict(v)
+        # keep within profile range loosely (scoring will do the rest)
+        if v and (min(v) < prof["lo"] - 12 or max(v) > prof["hi"] + 12):
+            continue
+        add(_prefer_bass_zone(v))
+
+    # Spread variants
+    # Default/low: mild spread only. Wide: allow more.
+    max_k = min(2, n - 1) if mode in ("default", "low") else min(3, n - 1)
+    for k in range(1, max_k + 1):
+        v_up = base[:]
+        for i in range(n - k, n):
+            v_up[i] += 12
+        add(_prefer_bass_zone(v_up))
+
+        v_dn = base[:]
+        for i in range(0, k):
+            v_dn[i] -= 12
+        add(_prefer_bass_zone(v_dn))
+
+    if extended:
+        inv = base[:]
+        for _ in range(n):
+            for shift in (-12, 0, 12):
+                add([x + shift for x in inv])
+                if n >= 3:
+                    # drop-2: second-highest voice down an octave
+                    d2 = sorted(x + shift for x in inv)
+                    d2[-2] -= 12
+                    add(d2)
+            inv = inv[1:] + [inv[0] + 12]
+
+        for k in range(max_k + 1, n):
+            add(base[:n - k] + [x + 12 for x in base[n - k:]])
+            add([x - 12 for x in base[:k]] + base[k:])
+
+    out = [list(c) for c in candidates]
+    return out if out else [_prefer_bass_zone(base)]
+
+
+# 12-bit pitch-class mask -> number of pitch classes
+_POPCOUNT_12 = np.array([bin(i).count("1") for i in range(1 << 12)], dtype=np.int64)
+
+
+def _pack_voicings(normed: List[List[int]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(candidates x max voices) int array right-padded with each row's top note, lengths, voice mask."""
+    width = max(1, max(len(v) for v in normed))
+    arr = np.array([(v + v[-1:] * (width - len(v))) if v else [0] * width for v in normed], dtype=np.int64)
+    lens = np.array([len(v) for v in normed], dtype=np.int64)
+    mask = np.arange(width)[None, :] < lens[:, None]
+    return arr, lens, mask
+
+
+def _voicing_static_costs(normed: List[List[int]], raw_clean: List[int], prof: dict) -> np.ndarray:
+    """
+    Cost terms that do not depend on the previous chord: bass preference,
+    register, span, spacing, top note and raw shape. Candidates (each sorted)
+    are packed into a (candidates x max voices) array, right-padded with their
+    own top note; `mask` marks the real voices. Every term is integer-valued
+    (or .5), so splitting the sum never changes a comparison. Invalid rows cost 1e12.
+    """
+    arr, lens, mask = _pack_voicings(normed)
+
+    lo = arr[:, 0]
+    hi = arr[:, -1]
+    invalid = (lens == 0) | (lo < ABS_NOTE_FLOOR) | (hi > ABS_NOTE_CEIL)
+
+    # Bass preference penalty (unchanged)
+    bass_pref_pen = (np.maximum(BASS_PREF_MIN - lo, 0) + np.maximum(lo - BASS_PREF_MAX, 0)) * 300.0
+
+    # Mode-aware register + span targets
+    reg_pen = np.abs((lo + hi) / 2.0 - prof["target_center"]) * prof["w_center"]
+    sp = hi - lo
+    span_pen = (np.abs(sp - prof["ideal_span"]) * prof["w_span"]
+                + np.maximum(prof["min_span"] - sp, 0) * 1200.0
+                + np.maximum(sp - prof["max_span"], 0) * 800.0)
+
+    # Spacing (padding gaps are 0 and masked out)
+    gaps = np.diff(arr, axis=1)
+    gp = (np.maximum(MIN_ADJ_GAP - gaps, 0) * 900.0
+          + np.maximum(gaps - MAX_ADJ_GAP, 0) * 420.0
+          + np.maximum(gaps - HARD_MAX_ADJ_GAP, 0) * 1200.0)
+    space_pen = (gp * mask[:, 1:]).sum(axis=1)
+
+    total = bass_pref_pen + reg_pen + span_pen + space_pen
+
+    # Top note brightness control
+    total = total + np.maximum(hi - (prof["hi"] - 6), 0) * prof["w_top"]
+
+    # Avoid the "raw" shape
+    if ENFORCE_NOT_RAW_WHEN_VOICING:
+        r = sorted(raw_clean)
+        total = total + np.array([v == r for v in normed]) * float(RAW_PENALTY)
+
+    return np.where(invalid, 1e12, total)
+
+
+def _voicing_transition_costs(normed: List[List[int]], prev_voicing: List[int], prof: dict) -> np.ndarray:
+    """Movement, leap, shared pitch-class, bass-jump and exact-repeat terms against prev_voicing."""
+    arr, _, mask = _pack_voicings(normed)
+    total = np.zeros(len(normed))
+
+    p = sorted(prev_voicing)
+    k = min(len(p), arr.shape[1])
+    if k:
+        d = np.abs(arr[:, :k] - np.array(p[:k], dtype=np.int64)) * mask[:, :k]
+        worst = d.max(axis=1)
+        total = total + d.sum(axis=1) * prof["w_move"]
+        total = total + np.maximum(worst - 5, 0) ** 2 * prof["w_leap"]
+
+    # reward shared pitch classes (padding repeats the top note's pc)
+    cand_pc = np.bitwise_or.reduce(1 << (arr % 12), axis=1)
+    total = total - _POPCOUNT_12[cand_pc & _pcs_to_mask(p)] * prof["w_shared_bonus"]
+
+    if prev_voicing:
+        total = total + np.maximum(np.abs(arr[:, 0] - min(prev_voicing)) - MAX_BASS_JUMP, 0) * 260.0
+
+    # Avoid exact repeats
+    return total + np.array([v == p for v in normed]) * 900.0
+
+
+def _voicing_costs(
+    normed: List[List[int]],
+    prev_voicing: Optional[List[int]],
+    raw_clean: List[int],
+    prof: dict,
+    static: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Cost of every candidate at once: static terms (precomputed ones may be
+    passed in) plus the transition terms when there is a previous voicing.
+    """
+    if static is None:
+        static = _voicing_static_costs(normed, raw_clean, prof)
+    if prev_voicing is None:
+        return static
+    return np.where(static >= 1e12, 1e12, static + _voicing_transition_costs(normed, prev_voicing, prof))
+
+
+def choose_best_voicing(
+    prev_voicing: Optional[List[int]],
+    prev_name: str,
+    cur_name: str,
+    raw_notes: List[int],
+    key_name: str,
+    rng: random.Random,
+    shared_limit: Optional[int] = None,
+) -> List[int]:
+
+    mode = VOICING_MODE  # NEW: default/wide/low
+    prof = VOICING_PROFILES.get(mode, VOICING_PROFILES["default"])
+
+    raw_clean = _prefer_bass_zone(_sanitize_notes_strict(raw_notes))
+    # candidates, their normalized forms and static costs come precomputed
+    all_cands, all_normed, all_static = get_voicing_table(mode).lookup(raw_clean)
+
+    # Glue filter (keep your behavior)
+    idxs = [i for i, v in enumerate(all_cands) if glue_ok(v, rng)] or list(range(len(all_cands)))
+    cands = [all_cands[i] for i in idxs]
+    normed = [all_normed[i] for i in idxs]
+    static = [all_static[i] for i in idxs]
+
+    # Repair cross-semitones (keep your behavior); only repaired shapes are re-scored
+    if prev_voicing is not None:
+        bad = _cross_semitone_targets(prev_voicing, allowed_resolution_pcs(key_name))
+        for j, v in enumerate(cands):
+            fixed = _repair_cross_semitones_mask(bad, v)
+            if fixed != v:
+                cands[j] = fixed
+                normed[j] = _prefer_bass_zone(_sanitize_notes_strict(fixed))
+                static[j] = None
+
+    # Shared tone cap (keep your behavior)
+    if prev_voicing is not None:
+        limit = shared_limit if shared_limit is not None else max_shared_allowed(prev_name, cur_name)
+        prev_mask = _pitch_mask(prev_voicing)
+        keep = [j for j, v in enumerate(cands) if (prev_mask & _pitch_mask(v)).bit_count() <= limit]
+        if keep:
+            normed = [normed[j] for j in keep]
+            static = [static[j] for j in keep]
+
+    if not normed:
+        return _prefer_bass_zone(_sanitize_notes_strict(raw_clean))
+
+    missing = [j for j, c in enumerate(static) if c is None]
+    if missing:
+        fresh = _voicing_static_costs([normed[j] for j in missing], raw_clean, prof)
+        for j, c in zip(missing, fresh):
+            static[j] = c
+
+    costs = _voicing_costs(normed, prev_voicing, raw_clean, prof, static=np.array(static, dtype=float))
+    return normed[int(np.argmin(costs))]
+
+# =========================================================
+# GLOBAL TIMING + EXPORT SETTINGS
+# =========================================================
+
+DOWNLOAD_NAME = "MIDI_Progressions_Aural_Alchemy.zip"
+
+BPM = 85
+TIME_SIG = (4, 4)
+BASE_OCTAVE = 3
+VELOCITY = 100
+
+BAR_DIR = {
+    4: "4-bar",
+    8: "8-bar",
+    16: "16-bar"
+}
+
+def sec_per_bar(bpm=BPM, ts=TIME_SIG):
+    return (60.0 / bpm) * ts[0]
+
+SEC_PER_BAR = sec_per_bar()
+
+
+
+
+# =========================================================
+# EXPORTER (PATCH 3: HARD REGISTER LOCK + REGISTER OPTIMIZER)
+# =========================================================
+
+# IMPORTANT:
+# MIDI numbers are identical in every DAW. Only the octave labels differ.
+# So we enforce safety by MIDI note numbers only.
+
+# Make sure these exist above this exporter section in your file:
+# BPM, TIME_SIG, BASE_OCTAVE, VELOCITY, SEC_PER_BAR, BAR_DIR
+# chord_to_midi(), choose_best_voicing(), _min_assignment_move()
+
+def safe_token(s: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_#-]+", "", str(s))
+
+
+def chord_list_token(chords):
+    return "-".join(safe_token(c) for c in chords)
+
+
+# =========================================================
+# GLOBAL REGISTER LOCK (edit these any time)
+# =========================================================
+BASS_MIN_MIDI = 40     # bass must not be below this
+BASS_MAX_MIDI = 52     # bass should not be above this (we pull down if safe)
+
+NOTE_MIN_MIDI = 40     # absolute floor for ANY note (hard ban below this)
+NOTE_MAX_MIDI = 88     # soft ceiling (keeps voicings from flying too high)
+
+MAX_OCTAVE_SHIFTS = 6  # safety cap so we never loop forever
+
+
+# =========================================================
+# GLOBAL TRANSPOSE (MASTER OCTAVE SHIFT)
+# =========================================================
+GLOBAL_TRANSPOSE = 12   # 12 = +1 octave, 0 = off
+
+
+def _shift_octaves(notes: List[int], octs: int) -> List[int]:
+    return [int(n + 12 * octs) for n in notes]
+
+
+REGISTER_CACHE_SIZE = 8192   # distinct pitch sets kept by the register lock
+
+
+def _enforce_register(notes: List[int]) -> List[int]:
+    """
+    Hard guarantees:
+    1) No note below NOTE_MIN_MIDI, ever.
+    2) Bass (min note) forced into BASS_MIN_MIDI..BASS_MAX_MIDI using whole-chord octave shifts.
+    3) Keep top under NOTE_MAX_MIDI when possible.
+    The result depends only on the pitch set, so it is memoized on the sorted tuple.
+    """
+    if not notes:
+        return []
+    return list(_register_lock(tuple(sorted(set(int(n) for n in notes)))))
+
+
+@lru_cache(maxsize=REGISTER_CACHE_SIZE)
+def _register_lock(pitches: Tuple[int, ...]) -> Tuple[int, ...]:
+    v = list(pitches)
+
+    # 1) Absolute floor. Push up by octaves until safe.
+    for _ in range(MAX_OCTAVE_SHIFTS):
+        if min(v) >= NOTE_MIN_MIDI:
+            break
+        v = sorted(set(_shift_octaves(v, +1)))
+
+    # If still below floor after cap, hard clamp by pushing all offending notes up
+    if min(v) < NOTE_MIN_MIDI:
+        fixed = []
+        for n in v:
+            while n < NOTE_MIN_MIDI:
+                n += 12
+            fixed.append(n)
+        v = sorted(set(fixed))
+
+    # 2) Force bass into requested window by shifting whole chord.
+    for _ in range(MAX_OCTAVE_SHIFTS):
+        if min(v) >= BASS_MIN_MIDI:
+            break
+        v = sorted(set(_shift_octaves(v, +1)))
+
+    for _ in range(MAX_OCTAVE_SHIFTS):
+        if min(v) <= BASS_MAX_MIDI:
+            break
+        candidate = sorted(set(_shift_octaves(v, -1)))
+        if min(candidate) >= NOTE_MIN_MIDI:
+            v = candidate
+        else:
+            break
+
+    # 3) Ceiling control.
+    for _ in range(MAX_OCTAVE_SHIFTS):
+        if max(v) <= NOTE_MAX_MIDI:
+            break
+        candidate = sorted(set(_shift_octaves(v, -1)))
+        if min(candidate) < NOTE_MIN_MIDI:
+            break
+        v = candidate
+
+    # Final hard floor re-check
+    for _ in range(MAX_OCTAVE_SHIFTS):
+        if min(v) >= NOTE_MIN_MIDI:
+            break
+        v = sorted(set(_shift_octaves(v, +1)))
+
+    if min(v) < NOTE_MIN_MIDI:
+        fixed = []
+        for n in v:
+            while n < NOTE_MIN_MIDI:
+                n += 12
+            fixed.append(n)
+        v = sorted(set(fixed))
+
+    return tuple(v)
+
+
+@lru_cache(maxsize=REGISTER_CACHE_SIZE)
+def _register_shifts(pitches: Tuple[int, ...], shifts: Tuple[int, ...]) -> Tuple[Tuple[int, ...], ...]:
+    """Distinct register-locked results of shifting one chord by each octave count, in shift order."""
+    out = []
+    for k in shifts:
+        cand = _register_lock(tuple(p + 12 * k for p in pitches))
+        if cand not in out:
+            out.append(cand)
+    return tuple(out)
+
+
+def register_cache_stats() -> Dict[str, dict]:
+    """Hit/miss counts and hit rate of the register-lock caches."""
+    out = {}
+    for name, fn in (("register", _register_lock), ("shifts", _register_shifts)):
+        info = fn.cache_info()
+        total = info.hits + info.misses
+        out[name] = {
+            "hits": info.hits,
+            "misses": info.misses,
+            "size": info.currsize,
+            "hit_rate": (info.hits / total) if total else 0.0,
+        }
+    return out
+
+
+def validate_progressions(progressions):
+    if not progressions:
+        raise ValueError("No progressions generated.")
+    for i, item in enumerate(progressions, start=1):
+        validate_progression(i, item)
+
+
+def validate_progression(i: int, item):
+    if len(item) != 3:
+        raise ValueError(f"Progression {i} must be (chords, durations, key).")
+    chords, durations, key_name = item
+    if len(chords) != len(durations):
+        raise ValueError(f"Progression {i}: chords/durations mismatch.")
+    bars = sum(durations)
+    if bars not in (4, 8, 16):
+        raise ValueError(f"Progression {i}: invalid bar sum {bars}.")
+    for ch in chords:
+        _ = raw_chord_notes(ch)
+
+
+# =========================================================
+# REGISTER OPTIMIZER (shared PCs + adjacency wins when needed)
+# =========================================================
+def _pc_mask(notes: List[int]) -> int:
+    return _pc_fold(_pitch_mask(notes))
+
+
+def _adjacent_pc_mask(prev_pcs: int, cur_pcs: int, dist: int = 1) -> int:
+    targets = 0
+    for d in range(1, dist + 1):
+        targets |= _pc_rotate(prev_pcs, d) | _pc_rotate(prev_pcs, -d)
+    return (cur_pcs & targets).bit_count()
+
+
+def _voice_leading_cost(prev: List[int], cur: List[int]) -> float:
+    return _min_assignment_move(prev, cur)
+
+
+def optimize_progression_register(
+    chords_notes: List[List[int]],
+    search_shifts=range(-3, 4),
+) -> List[List[int]]:
+    """
+    For each chord after the first, try octave shifts and pick the best one.
+
+    Priority:
+    - More shared pitch-classes is good
+    - If shared is lower, adjacency (semi/whole tone) can win (your request)
+    - Less total movement is better
+    - Smaller bass jumps are better
+
+    Always respects _enforce_register.
+    """
+    if not chords_notes:
+        return chords_notes
+
+    out: List[List[int]] = []
+    prev = _enforce_register(chords_notes[0])
+    out.append(prev)
+
+    shifts = tuple(search_shifts)
+
+    for cur_raw in chords_notes[1:]:
+        best = None
+        best_score = None
+        prev_pcs = _pc_mask(prev)
+
+        # shifts that lock to the same voicing score the same, so each is tried once
+        pitches = tuple(sorted(set(int(n) for n in cur_raw)))
+        for locked in _register_shifts(pitches, shifts):
+            cand = list(locked)
+
+            cand_pcs = _pc_mask(cand)
+            shared = (prev_pcs & cand_pcs).bit_count()
+            adj1 = _adjacent_pc_mask(prev_pcs, cand_pcs, dist=1)
+            adj2 = _adjacent_pc_mask(prev_pcs, cand_pcs, dist=2)
+
+            move = _voice_leading_cost(prev, cand)
+            bass_jump = abs(min(cand) - min(prev))
+
+            # adjacency can beat fewer shared tones:
+            # nearness weights tuned so:
+            # shared matters, but adj1 can overtake when shared drops by 1
+            nearness = shared * 2 + adj1 * 3 + adj2 * 1
+
+            score = (nearness, -move, -bass_jump)
+
+            if best_score is None or score > best_score:
+                best_score = score
+                best = cand
+
+        prev = best if best is not None else _enforce_register(cur_raw)
+        out.append(prev)
+
+    return out
+
+
+# =========================================================
+# WHOLE-PROGRESSION VOICE LEADING (Viterbi)
+# Scores every chord's candidates once, prices every candidate pair between
+# neighbouring chords, then finds the cheapest path: O(n * k^2) for an open
+# chain. With loop closure (the default) the last->first transition is priced
+# too, exactly: every first-chord candidate is carried as its own start state,
+# so each step is O(k0 * k^2) and a progression O(n * k^3) (64k sums per step
+# at VITERBI_MAX_CANDIDATES). After the glue filter real sets stay under ~20
+# candidates: ~1.4 ms per progression with closure vs ~1.0 ms without.
+# =========================================================
+VOICING_OPTIMIZERS = ("greedy", "viterbi")
+VOICING_OPTIMIZER = "greedy"
+VITERBI_LOOP_CLOSURE = True
+VITERBI_MAX_CANDIDATES = 40             # per chord, cheapest by static cost (bounds time per progression)
+VITERBI_CROSS_SEMITONE_PENALTY = 700.0  # per voice that lands a semitone from a previous voice
+VITERBI_SHARED_CAP_PENALTY = 900.0      # per shared pitch over max_shared_allowed
+
+# Process-local: render threads share it (under the lock), forked render
+# workers update their own copy, so process-pool renders are not counted here.
+VITERBI_TIMING = {"progressions": 0, "total_ms": 0.0, "max_ms": 0.0, "max_candidates": 0}
+_VITERBI_TIMING_LOCK = threading.Lock()
+
+
+def _transition_costs(
+    prev_cands: List[List[int]],
+    cur_cands: List[List[int]],
+    prof: dict,
+    shared_limit: int,
+    allowed_mask: int,
+) -> np.ndarray:
+    """
+    (len(prev_cands) x len(cur_cands)) cost of moving between every pair.
+    Same movement terms as _voicing_costs; the greedy path's cross-semitone
+    repair and shared-pitch cap become penalties here.
+    """
+    A, la, _ = _pack_voicings(prev_cands)
+    B, lb, _ = _pack_voicings(cur_cands)
+    w = min(A.shape[1], B.shape[1])
+    k = np.minimum(la[:, None], lb[None, :])
+    d = np.abs(A[:, None, :w] - B[None, :, :w]) * (np.arange(w)[None, None, :] < k[:, :, None])
+
+    cost = d.sum(axis=2) * prof["w_move"] + np.maximum(d.max(axis=2) - 5, 0) ** 2 * prof["w_leap"]
+
+    pc_a = np.bitwise_or.reduce(1 << (A % 12), axis=1)
+    pc_b = np.bitwise_or.reduce(1 << (B % 12), axis=1)
+    cost = cost - _POPCOUNT_12[pc_a[:, None] & pc_b[None, :]] * prof["w_shared_bonus"]
+    cost = cost + np.maximum(np.abs(B[None, :, 0] - A[:, None, 0]) - MAX_BASS_JUMP, 0) * 260.0
+
+    masks_a = [_pitch_mask(v) for v in prev_cands]
+    masks_b = [_pitch_mask(v) for v in cur_cands]
+    extra = np.zeros(cost.shape)
+    for i, ma in enumerate(masks_a):
+        near = _semitone_neighbours(ma) & ~allowed_mask
+        for j, mb in enumerate(masks_b):
+            e = (mb & near).bit_count() * VITERBI_CROSS_SEMITONE_PENALTY
+            e += max((ma & mb).bit_count() - shared_limit, 0) * VITERBI_SHARED_CAP_PENALTY
+            if ma == mb:
+                e += 900.0
+            extra[i, j] = e
+    return cost + extra
+
+
+def _viterbi_path(
+    static: List[np.ndarray],
+    trans: List[np.ndarray],
+    closure: Optional[np.ndarray] = None,
+) -> List[int]:
+    """
+    Minimum-cost candidate index per chord. static[i] is (k_i,), trans[i] is
+    (k_i x k_i+1); closure (k_last x k_0) adds the wrap-around transition.
+    """
+    if closure is None:
+        score = static[0]
+        back = []
+        for t, st_cost in zip(trans, static[1:]):
+            tot = score[:, None] + t
+            arg = tot.argmin(axis=0)
+            score = tot[arg, np.arange(t.shape[1])] + st_cost
+            back.append(arg)
+        j = int(score.argmin())
+        path = [j]
+        for arg in reversed(back):
+            j = int(arg[j])
+            path.append(j)
+        return path[::-1]
+
+    # score[s, j]: cheapest path that starts on candidate s and is on j now
+    k0 = len(static[0])
+    score = np.full((k0, k0), np.inf)
+    np.fill_diagonal(score, static[0])
+    back = []
+    for t, st_cost in zip(trans, static[1:]):
+        tot = score[:, :, None] + t[None, :, :]
+        arg = tot.argmin(axis=1)
+        score = np.take_along_axis(tot, arg[:, None, :], axis=1)[:, 0, :] + st_cost
+        back.append(arg)
+    final = score + closure.T
+    s, j = np.unravel_index(int(final.argmin()), final.shape)
+    s, j = int(s), int(j)
+    path = [j]
+    for arg in reversed(back):
+        j = int(arg[s, j])
+        path.append(j)
+    return path[::-1]
+
+
+def voice_progression_viterbi(
+    chords,
+    raw_notes: List[List[int]],
+    key_name: str,
+    rng: random.Random,
+    loop: bool = VITERBI_LOOP_CLOSURE,
+    limits: Optional[List[int]] = None,
+) -> List[List[int]]:
+    """
+    Whole-progression voicing. Candidates are register-locked before scoring,
+    so the costs are measured on the notes that get exported.
+    limits[i] is the shared-pitch cap from chord i to chord i+1 (wrapping).
+    """
+    t0 = time.perf_counter()
+    mode = VOICING_MODE
+    prof = VOICING_PROFILES.get(mode, VOICING_PROFILES["default"])
+    allowed_mask = _octaves_mask(_pcs_to_mask(allowed_resolution_pcs(key_name)))
+
+    table = get_voicing_table(mode)
+
+    cand_sets, static = [], []
+    for notes in raw_notes:
+        raw_clean = _prefer_bass_zone(_sanitize_notes_strict(notes))
+        all_cands, locked, locked_cost = table.lookup_extended(raw_clean)
+
+        # Glue filter (same rule as the greedy path)
+        idxs = [i for i, v in enumerate(all_cands) if glue_ok(v, rng)] or range(len(all_cands))
+
+        cost_of = {locked[i]: locked_cost[i] for i in idxs}
+        uniq = sorted(cost_of)
+        cands = [list(v) for v in uniq]
+        costs = np.array([cost_of[v] for v in uniq], dtype=float)
+        if len(cands) > VITERBI_MAX_CANDIDATES:
+            keep = np.sort(np.argsort(costs, kind="stable")[:VITERBI_MAX_CANDIDATES])
+            cands = [cands[i] for i in keep]
+            costs = costs[keep]
+        cand_sets.append(cands)
+        static.append(costs)
+
+    n = len(cand_sets)
+    if limits is None:
+        limits = _shared_limits(chords, chord_ids(chords))
+    trans = [_transition_costs(cand_sets[i], cand_sets[i + 1], prof, limits[i], allowed_mask) for i in range(n - 1)]
+    closure = None
+    if loop and n >= 2:
+        closure = _transition_costs(cand_sets[-1], cand_sets[0], prof, limits[-1], allowed_mask)
+
+    path = _viterbi_path(static, trans, closure)
+    out = [cand_sets[i][j] for i, j in enumerate(path)]
+
+    ms = (time.perf_counter() - t0) * 1000.0
+    widest = max(len(c) for c in cand_sets)
+    with _VITERBI_TIMING_LOCK:
+        VITERBI_TIMING["progressions"] += 1
+        VITERBI_TIMING["total_ms"] += ms
+        VITERBI_TIMING["max_ms"] = max(VITERBI_TIMING["max_ms"], ms)
+        VITERBI_TIMING["max_candidates"] = max(VITERBI_TIMING["max_candidates"], widest)
+    return out
+
+
+# =========================================================
+# VOICING TABLE
+# Candidate voicings plus their prev-independent cost terms for every raw
+# chord shape, per profile. Built once (or loaded from a versioned .npz) and
+# shared across sessions, so render time only prices transitions.
+# =========================================================
+VOICING_TABLE_VERSION = 1
+VOICING_TABLE_DIR = os.environ.get("AA_VOICING_TABLE_DIR", "")   # "" = build in memory only
+
+_VOICING_TABLES: Dict[str, "VoicingTable"] = {}
+
+
+def _voicing_table_fingerprint(mode: str) -> str:
+    parts = (
+        VOICING_TABLE_VERSION,
+        mode,
+        sorted(VOICING_PROFILES.get(mode, VOICING_PROFILES["default"]).items()),
+        ABS_NOTE_FLOOR, ABS_NOTE_CEIL, BASS_PREF_MIN, BASS_PREF_MAX, BASS_HARD_MIN, BASS_HARD_MAX,
+        MIN_ADJ_GAP, MAX_ADJ_GAP, HARD_MAX_ADJ_GAP, ENFORCE_NOT_RAW_WHEN_VOICING, RAW_PENALTY,
+        NOTE_MIN_MIDI, NOTE_MAX_MIDI, BASS_MIN_MIDI, BASS_MAX_MIDI, MAX_OCTAVE_SHIFTS,
+    )
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def _voicing_vocabulary() -> List[Tuple[int, ...]]:
+    """Every cleaned raw chord shape the generator can emit (one per chord ID)."""
+    shapes = set()
+    for cid in range(N_CHORD_IDS):
+        raw = list(chord_id_notes(cid))
+        shapes.add(tuple(_prefer_bass_zone(_sanitize_notes_strict(raw))))
+    return sorted(shapes)
+
+
+class VoicingTable:
+    """
+    Per-profile lookup keyed by the cleaned raw chord shape.
+    basic[shape]    = (cands, normed, static) for choose_best_voicing
+    extended[shape] = (cands, locked, static) for voice_progression_viterbi
+    cands keep their generation order so glue_ok draws the same RNG values.
+    Unknown shapes are built on first lookup.
+    """
+    __slots__ = ("mode", "prof", "basic", "extended")
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.prof = VOICING_PROFILES.get(mode, VOICING_PROFILES["default"])
+        self.basic = {}
+        self.extended = {}
+
+    def lookup(self, raw_clean: List[int]):
+        key = tuple(raw_clean)
+        entry = self.basic.get(key)
+        if entry is None:
+            cands = generate_voicing_candidates(list(key), self.mode)
+            normed = [_prefer_bass_zone(_sanitize_notes_strict(v)) for v in cands]
+            static = [float(c) for c in _voicing_static_costs(normed, list(key), self.prof)]
+            entry = self.basic[key] = (cands, normed, static)
+        return entry
+
+    def lookup_extended(self, raw_clean: List[int]):
+        key = tuple(raw_clean)
+        entry = self.extended.get(key)
+        if entry is None:
+            cands = sorted(generate_voicing_candidates(list(key), self.mode, extended=True))
+            locked = [tuple(_enforce_register(v)) for v in cands]
+            static = [float(c) for c in _voicing_static_costs([list(v) for v in locked], list(key), self.prof)]
+            entry = self.extended[key] = (cands, locked, static)
+        return entry
+
+
+def _pack_rows(rows) -> np.ndarray:
+    width = max([len(r) for r in rows] + [1])
+    out = np.full((len(rows), width), -1, dtype=np.int16)
+    for i, r in enumerate(rows):
+        out[i, :len(r)] = r
+    return out
+
+
+def _unpack_rows(arr: np.ndarray) -> List[List[int]]:
+    return [[int(x) for x in row if x >= 0] for row in arr]
+
+
+def _voicing_table_path(mode: str) -> str:
+    return os.path.join(VOICING_TABLE_DIR, f"voicing_table_v{VOICING_TABLE_VERSION}_{safe_token(mode)}.npz")
+
+
+def save_voicing_table(table: VoicingTable, path: str):
+    arrays = {"fingerprint": np.array(_voicing_table_fingerprint(table.mode))}
+    for name, entries, second in (("basic", table.basic, "normed"), ("extended", table.extended, "locked")):
+        keys = sorted(entries)
+        offsets = np.cumsum([0] + [len(entries[k][0]) for k in keys])
+        arrays[f"{name}_keys"] = _pack_rows(keys)
+        arrays[f"{name}_offsets"] = offsets.astype(np.int64)
+        arrays[f"{name}_cands"] = _pack_rows([v for k in keys for v in entries[k][0]])
+        arrays[f"{name}_{second}"] = _pack_rows([v for k in keys for v in entries[k][1]])
+        arrays[f"{name}_static"] = np.array([c for k in keys for c in entries[k][2]], dtype=np.float64)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp, path)
+
+
+def load_voicing_table(mode: str, path: str) -> Optional[VoicingTable]:
+    """None when the file is missing, unreadable or built with other settings."""
+    try:
+        with np.load(path, allow_pickle=False) as z:
+            if str(z["fingerprint"]) != _voicing_table_fingerprint(mode):
+                return None
+            data = {k: z[k] for k in z.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+    table = VoicingTable(mode)
+    for name, entries, second in (("basic", table.basic, "normed"), ("extended", table.extended, "locked")):
+        offsets = data[f"{name}_offsets"]
+        cands = _unpack_rows(data[f"{name}_cands"])
+        other = _unpack_rows(data[f"{name}_{second}"])
+        if name == "extended":
+            other = [tuple(v) for v in other]
+        static = [float(c) for c in data[f"{name}_static"]]
+        for i, key in enumerate(_unpack_rows(data[f"{name}_keys"])):
+            a, b = int(offsets[i]), int(offsets[i + 1])
+            entries[tuple(key)] = (cands[a:b], other[a:b], static[a:b])
+    return table
+
+
+def build_voicing_table(mode: str) -> VoicingTable:
+    table = VoicingTable(mode)
+    for shape in _voicing_vocabulary():
+        table.lookup(list(shape))
+        table.lookup_extended(list(shape))
+    return table
+
+
+def _load_or_build_voicing_table(mode: str) -> VoicingTable:
+    path = _voicing_table_path(mode) if VOICING_TABLE_DIR else ""
+    table = load_voicing_table(mode, path) if path else None
+    if table is None:
+        table = build_voicing_table(mode)
+        if path:
+            try:
+                save_voicing_table(table, path)
+            except OSError:
+                pass
+    return table
+
+
+def get_voicing_table(mode: str) -> VoicingTable:
+    """Process-wide table for a profile, loaded or built on first use."""
+    table = _VOICING_TABLES.get(mode)
+    if table is None:
+        table = _VOICING_TABLES[mode] = _load_or_build_voicing_table(mode)
+    return table
+
+
+# =========================================================
+# DIRECT SMF ENCODER (block chords -> .mid bytes, no pretty_midi/mido)
+# Format 0, one track: tempo + time signature, program change,
+# then note on/off at block boundaries using running status
+# (note off = note on with velocity 0).
+# =========================================================
+USE_DIRECT_SMF = True   # False = export through pretty_midi
+SMF_PPQ = 480
+
+
+def _vlq(n: int) -> bytes:
+    out = [n & 0x7F]
+    n >>= 7
+    while n:
+        out.append(0x80 | (n & 0x7F))
+        n >>= 7
+    return bytes(reversed(out))
+
+
+def encode_block_chord_smf(
+    blocks: List[Tuple[List[int], int]],
+    bpm: float = BPM,
+    ts: Tuple[int, int] = TIME_SIG,
+    velocity: int = VELOCITY,
+    program: int = 0,
+) -> bytes:
+    """
+    blocks: [(pitches, bars), ...] played back to back from bar 0.
+    """
+    ticks_per_bar = (SMF_PPQ * 4 * ts[0]) // ts[1]
+    tempo = int(60_000_000 / bpm)
+    vel = int(velocity) & 0x7F
+
+    trk = bytearray()
+    trk += b"\x00\xff\x51\x03" + tempo.to_bytes(3, "big")
+    trk += b"\x00\xff\x58\x04" + bytes((ts[0], int(ts[1]).bit_length() - 1, 24, 8))
+    trk += bytes((0x00, 0xC0, program & 0x7F))
+
+    status = None
+    pending = 0          # ticks since the last event
+    for pitches, bars in blocks:
+        for p in pitches:
+            trk += _vlq(pending)
+            if status != 0x90:
+                trk.append(0x90)
+                status = 0x90
+            trk += bytes((p & 0x7F, vel))
+            pending = 0
+
+        pending += int(bars) * ticks_per_bar
+
+        for p in pitches:
+            trk += _vlq(pending)
+            trk += bytes((p & 0x7F, 0))
+            pending = 0
+
+    trk += _vlq(pending) + b"\xff\x2f\x00"
+
+    header = b"MThd" + (6).to_bytes(4, "big") + (0).to_bytes(2, "big") + (1).to_bytes(2, "big") + SMF_PPQ.to_bytes(2, "big")
+    return header + b"MTrk" + len(trk).to_bytes(4, "big") + bytes(trk)
+
+
+def _pretty_midi_bytes(blocks: List[Tuple[List[int], int]]) -> bytes:
+    import pretty_midi   # heavy; only the fallback exporter needs it
+
+    midi = pretty_midi.PrettyMIDI(initial_tempo=BPM)
+    midi.time_signature_changes = [pretty_midi.TimeSignature(TIME_SIG[0], TIME_SIG[1], 0)]
+    inst = pretty_midi.Instrument(program=0)
+
+    t = 0.0
+    for pitches, bars in blocks:
+        dur = bars * SEC_PER_BAR
+        for p in pitches:
+            inst.notes.append(pretty_midi.Note(
+                velocity=int(VELOCITY),
+                pitch=int(p),
+                start=t,
+                end=t + dur
+            ))
+        t += dur
+
+    midi.instruments.append(inst)
+    buf = io.BytesIO()
+    midi.write(buf)
+    return buf.getvalue()
+
+
+def _blocks_to_midi_bytes(blocks: List[Tuple[List[int], int]]) -> bytes:
+    if USE_DIRECT_SMF:
+        return encode_block_chord_smf(blocks)
+    return _pretty_midi_bytes(blocks)
+
+
+# =========================================================
+# MIDI WRITERS
+# render_* return (archive-relative path, .mid bytes); write_* put them on disk.
+# =========================================================
+RENDER_WORKERS = 0          # 0/1 = render in-process
+RENDER_POOL = "process"     # "process" | "thread"
+
+
+def _write_rendered(out_root: str, rel_path: str, data: bytes):
+    path = os.path.join(out_root, *rel_path.split("/"))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def render_progression_midi(
+    idx: int,
+    chords,
+    durations,
+    key_name: str,
+    revoice: bool,
+    seed: int,
+    optimizer: str = VOICING_OPTIMIZER,
+) -> Tuple[str, bytes]:
+    stats = _active_stats()
+    t0 = time.perf_counter() if stats is not None else 0.0
+
+    # RAW notes are always register locked
+    raw = [raw_chord_notes(ch) for ch in chords]
+    limits = _shared_limits(chords, chord_ids(chords)) if revoice else None
+
+    if revoice and optimizer == "viterbi":
+        # octave placement is already part of the joint optimum
+        out_notes = voice_progression_viterbi(chords, raw, key_name, random.Random(seed + idx), limits=limits)
+        if stats is not None:
+            t0 = stats.add_time("voice", t0)
+    elif revoice:
+        voiced = []
+        prev_v = None
+        prev_name = chords[0]
+        rng = random.Random(seed + idx)
+
+        for i, (ch_name, notes) in enumerate(zip(chords, raw)):
+            if prev_v is None:
+                v = choose_best_voicing(None, ch_name, ch_name, notes, key_name, rng)
+            else:
+                v = choose_best_voicing(prev_v, prev_name, ch_name, notes, key_name, rng, shared_limit=limits[i - 1])
+
+            v = _enforce_register(v)
+
+            voiced.append(v)
+            prev_v = v
+            prev_name = ch_name
+        if stats is not None:
+            t0 = stats.add_time("voice", t0)
+
+        # IMPORTANT: THIS IS THE PART YOU WERE MISSING (because of duplicate function)
+        out_notes = optimize_progression_register(voiced)
+        if stats is not None:
+            t0 = stats.add_time("register", t0)
+    else:
+        out_notes = optimize_progression_register(raw)
+        if stats is not None:
+            t0 = stats.add_time("register", t0)
+
+    blocks = []
+    for notes, bars in zip(out_notes, durations):
+        shifted = [int(p + GLOBAL_TRANSPOSE) for p in notes]
+        blocks.append((sorted(set(shifted)), bars))
+
+    total_bars = sum(durations)
+    rv_tag = "_Revoiced" if revoice else ""
+    filename = f"Prog_{idx:03d}_in_{safe_token(key_name)}_{chord_list_token(chords)}{rv_tag}.mid"
+    data = _blocks_to_midi_bytes(blocks)
+    if stats is not None:
+        stats.add_time("encode", t0)
+    return f"Progressions/{BAR_DIR[total_bars]}/{filename}", data
+
+
+def _chord_rel_path(chord_name: str, revoice: bool) -> str:
+    rv_tag = "_Revoiced" if revoice else ""
+    return f"Chords/{safe_token(chord_name)}{rv_tag}.mid"
+
+
+def render_single_chord_midi(
+    chord_name: str,
+    revoice: bool,
+    length_bars=4,
+    seed: int = 1337
+) -> Tuple[str, bytes]:
+    stats = _active_stats()
+    t0 = time.perf_counter() if stats is not None else 0.0
+    raw = raw_chord_notes(chord_name)
+
+    if revoice:
+        rng = random.Random(seed)
+        notes = choose_best_voicing(None, chord_name, chord_name, raw, "C", rng)
+        notes = _enforce_register(notes)
+    else:
+        notes = raw
+
+    notes = _enforce_register(notes)
+    if stats is not None:
+        t0 = stats.add_time("voice", t0)
+
+    shifted = [int(p + GLOBAL_TRANSPOSE) for p in notes]
+    blocks = [(sorted(set(shifted)), length_bars)]
+
+    data = _blocks_to_midi_bytes(blocks)
+    if stats is not None:
+        stats.add_time("encode", t0)
+    return _chord_rel_path(chord_name, revoice), data
+
+
+def write_progression_midi(
+    out_root: str,
+    idx: int,
+    chords,
+    durations,
+    key_name: str,
+    revoice: bool,
+    seed: int,
+    optimizer: str = VOICING_OPTIMIZER,
+):
+    _write_rendered(out_root, *render_progression_midi(idx, chords, durations, key_name, revoice, seed, optimizer))
+
+
+def write_single_chord_midi(
+    out_root: str,
+    chord_name: str,
+    revoice: bool,
+    length_bars=4,
+    seed: int = 1337
+):
+    _write_rendered(out_root, *render_single_chord_midi(chord_name, revoice, length_bars, seed))
+
+
+def _render_job(job) -> Tuple[str, bytes]:
+    kind, args = job
+    if kind == "chord":
+        return render_single_chord_midi(*args)
+    return render_progression_midi(*args)
+
+
+# =========================================================
+# CHORD LIBRARY CACHE
+# Finished Chords/*.mid bytes, content-addressed by everything that shapes
+# them. Process-wide LRU, plus an optional on-disk tier that survives restarts.
+# =========================================================
+CHORD_CACHE_VERSION = 1             # bump when voicing/export code changes the output
+CHORD_CACHE_MAX_ENTRIES = 4096
+CHORD_CACHE_DIR = os.environ.get("AA_CHORD_CACHE_DIR", "")   # "" = memory only
+
+_CHORD_CACHE: "OrderedDict[str, bytes]" = OrderedDict()
+_CHORD_CACHE_LOCK = threading.Lock()
+CHORD_CACHE_STATS = Counter()
+
+
+def _chord_cache_key(chord_name: str, revoice: bool, length_bars: int, seed: int) -> str:
+    parts = (
+        CHORD_CACHE_VERSION,
+        chord_name,
+        bool(revoice),
+        int(length_bars),
+        # the seed and profile only reach the output through the voicing engine
+        (VOICING_MODE, sorted(VOICING_PROFILES.get(VOICING_MODE, {}).items()), int(seed)) if revoice else None,
+        GLOBAL_TRANSPOSE, BPM, TIME_SIG, VELOCITY, USE_DIRECT_SMF, SMF_PPQ,
+        NOTE_MIN_MIDI, NOTE_MAX_MIDI, BASS_MIN_MIDI, BASS_MAX_MIDI,
+    )
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def _chord_cache_path(key: str) -> str:
+    return os.path.join(CHORD_CACHE_DIR, key[:2], f"{key}.mid")
+
+
+def chord_cache_get(key: str) -> Optional[bytes]:
+    with _CHORD_CACHE_LOCK:
+        data = _CHORD_CACHE.get(key)
+        if data is not None:
+            _CHORD_CACHE.move_to_end(key)
+            CHORD_CACHE_STATS["hits"] += 1
+            return data
+
+    if CHORD_CACHE_DIR:
+        try:
+            with open(_chord_cache_path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            data = None
+        if data:
+            CHORD_CACHE_STATS["disk_hits"] += 1
+            chord_cache_put(key, data, persist=False)
+            return data
+
+    CHORD_CACHE_STATS["misses"] += 1
+    return None
+
+
+def chord_cache_put(key: str, data: bytes, persist: bool = True):
+    with _CHORD_CACHE_LOCK:
+        _CHORD_CACHE[key] = data
+        _CHORD_CACHE.move_to_end(key)
+        while len(_CHORD_CACHE) > CHORD_CACHE_MAX_ENTRIES:
+            _CHORD_CACHE.popitem(last=False)
+
+    if persist and CHORD_CACHE_DIR:
+        path = _chord_cache_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+
+def chord_cache_clear():
+    with _CHORD_CACHE_LOCK:
+        _CHORD_CACHE.clear()
+    CHORD_CACHE_STATS.clear()
+
+
+def zip_pack(out_root: str, zip_path: str):
+    with ZipFile(zip_path, "w") as z:
+        for root, _, files in os.walk(out_root):
+            for f in files:
+                full = os.path.join(root, f)
+                rel = os.path.relpath(full, out_root)
+                z.write(full, arcname=rel)
+
+
+def zip_rendered(files, fileobj):
+    """
+    Writes (archive path, bytes) pairs straight into a ZIP, no files on disk.
+    """
+    with ZipFile(fileobj, "w") as z:
+        for rel_path, data in files:
+            z.writestr(rel_path, data)
+
+
+def _pack_zip_name(revoice: bool) -> str:
+    base = DOWNLOAD_NAME[:-4] if DOWNLOAD_NAME.lower().endswith(".zip") else DOWNLOAD_NAME
+    return f"{base}_Revoiced.zip" if revoice else DOWNLOAD_NAME
+
+
+def _chord_library_lookup(chord_names, revoice: bool, seed: int):
+    """Render args, cache keys and cached bytes (None = miss) for a pack's Chords/ files, by name."""
+    chord_args = [(ch, revoice, 4, seed + 999) for ch in sorted(chord_names)]
+    chord_keys = [_chord_cache_key(*args) for args in chord_args]
+    return chord_args, chord_keys, [chord_cache_get(k) for k in chord_keys]
+
+
+def _render_pack(
+    progressions,
+    revoice: bool,
+    seed: int,
+    workers: int,
+    pool: str,
+    optimizer: str = VOICING_OPTIMIZER,
+    stats: Optional[GenerationStats] = None,
+):
+    """
+    Renders every file on a worker pool (each job returns bytes).
+    Chord-library files come from the chord cache when possible; only misses
+    are rendered, and they are cached here in the parent process.
+    Returns ([(archive path, bytes), ...] in a fixed order, unique chord count).
+    """
+    if stats is None:
+        return _render_pack_files(progressions, revoice, seed, workers, pool, optimizer, None)
+    _STATS_LOCAL.stats = stats
+    try:
+        return _render_pack_files(progressions, revoice, seed, workers, pool, optimizer, stats)
+    finally:
+        _STATS_LOCAL.stats = None
+
+
+def _render_pack_files(progressions, revoice, seed, workers, pool, optimizer, stats):
+    t0 = time.perf_counter() if stats is not None else 0.0
+    validate_progressions(progressions)
+    if stats is not None:
+        t0 = stats.add_time("validate", t0)
+
+    jobs = []
+    unique_chords = set()
+    for i, (chords, durations, key_name) in enumerate(progressions, start=1):
+        jobs.append(("prog", (i, chords, durations, key_name, revoice, seed, optimizer)))
+        unique_chords.update(chords)
+    n_prog = len(jobs)
+
+    if revoice:
+        get_voicing_table(VOICING_MODE)   # build/load once here so forked workers inherit it
+        if stats is not None:
+            t0 = stats.add_time("voice", t0)
+
+    chord_args, chord_keys, chord_data = _chord_library_lookup(unique_chords, revoice, seed)
+    misses = [j for j, data in enumerate(chord_data) if data is None]
+    jobs += [("chord", chord_args[j]) for j in misses]
+
+    rendered = _run_jobs(_render_job, jobs, workers, kind=pool)
+    if stats is not None and workers > 1 and len(jobs) > 1:
+        # the per-file stages ran on the pool; only its wall time is visible here
+        stats.add_time("render (pool)", t0)
+
+    for j, (_, data) in zip(misses, rendered[n_prog:]):
+        chord_data[j] = data
+        chord_cache_put(chord_keys[j], data)
+
+    files = rendered[:n_prog]
+    files += [(_chord_rel_path(args[0], revoice), data) for args, data in zip(chord_args, chord_data)]
+    return files, len(unique_chords)
+
+
+class PackWriter:
+    """
+    Streaming pack: add() renders one progression and writes it straight into
+    the ZIP; close() appends the chord library. Same archive layout and file
+    bytes as build_pack_bytes. Only the archive itself and the set of chord
+    names grow with the pack.
+    """
+    __slots__ = ("revoice", "seed", "optimizer", "stats", "zip_name", "count", "_zip", "_chords")
+
+    def __init__(
+        self,
+        fileobj,
+        revoice: bool,
+        seed: int,
+        optimizer: str = VOICING_OPTIMIZER,
+        stats: Optional[GenerationStats] = None,
+    ):
+        self.revoice = revoice
+        self.seed = seed
+        self.optimizer = optimizer
+        self.stats = stats
+        self.zip_name = _pack_zip_name(revoice)
+        self.count = 0
+        self._chords = set()
+        self._zip = ZipFile(fileobj, "w")
+        if revoice:
+            t0 = time.perf_counter()
+            get_voicing_table(VOICING_MODE)
+            if stats is not None:
+                stats.add_time("voice", t0)
+
+    def add(self, progression) -> str:
+        """Renders and writes the next progression; returns its archive path."""
+        stats = self.stats
+        t0 = time.perf_counter() if stats is not None else 0.0
+        validate_progression(self.count + 1, progression)
+        if stats is not None:
+            stats.add_time("validate", t0)
+
+        chords, durations, key_name = progression
+        _STATS_LOCAL.stats = stats
+        try:
+            rel_path, data = render_progression_midi(
+                self.count + 1, chords, durations, key_name, self.revoice, self.seed, self.optimizer
+            )
+        finally:
+            _STATS_LOCAL.stats = None
+
+        t0 = time.perf_counter() if stats is not None else 0.0
+        self._zip.writestr(rel_path, data)
+        if stats is not None:
+            stats.add_time("zip", t0)
+        self.count += 1
+        self._chords.update(chords)
+        return rel_path
+
+    def close(self) -> int:
+        """Writes the chord library and finishes the archive; returns the unique chord count."""
+        if not self.count:
+            self._zip.close()
+            raise ValueError("No progressions generated.")
+        _STATS_LOCAL.stats = self.stats
+        try:
+            chord_args, chord_keys, chord_data = _chord_library_lookup(self._chords, self.revoice, self.seed)
+            for args, key, data in zip(chord_args, chord_keys, chord_data):
+                if data is None:
+                    data = render_single_chord_midi(*args)[1]
+                    chord_cache_put(key, data)
+                t0 = time.perf_counter()
+                self._zip.writestr(_chord_rel_path(args[0], self.revoice), data)
+                if self.stats is not None:
+                    self.stats.add_time("zip", t0)
+        finally:
+            _STATS_LOCAL.stats = None
+        t0 = time.perf_counter()
+        self._zip.close()
+        if self.stats is not None:
+            self.stats.add_time("zip", t0)
+        return len(self._chords)
+
+    def discard(self):
+        """Closes the archive after a failed add() (or an abandoned stream); it is not a usable pack."""
+        self._zip.close()
+
+
+def build_pack(
+    progressions,
+    revoice: bool,
+    seed: int,
+    workers: int = RENDER_WORKERS,
+    pool: str = RENDER_POOL,
+    optimizer: str = VOICING_OPTIMIZER,
+    stats: Optional[GenerationStats] = None,
+) -> tuple[str, int, str]:
+    """
+    Disk mode: writes the pack tree into a temp dir, then zips it.
+    Returns (zip_path, chord_count, zip_name).
+    """
+    files, chord_count = _render_pack(progressions, revoice, seed, workers, pool, optimizer, stats)
+    t0 = time.perf_counter()
+
+    workdir = tempfile.mkdtemp(prefix="aa_midi_")
+    prog_root = os.path.join(workdir, "Pack")
+    os.makedirs(prog_root, exist_ok=True)
+
+    for rel_path, data in files:
+        _write_rendered(prog_root, rel_path, data)
+
+    final_zip_name = _pack_zip_name(revoice)
+    zip_path = os.path.join(workdir, final_zip_name)
+    zip_pack(prog_root, zip_path)
+    if stats is not None:
+        stats.add_time("zip", t0)
+
+    return zip_path, chord_count, final_zip_name
+
+
+def write_pack(
+    fileobj,
+    progressions,
+    revoice: bool,
+    seed: int,
+    workers: int = RENDER_WORKERS,
+    pool: str = RENDER_POOL,
+    optimizer: str = VOICING_OPTIMIZER,
+    stats: Optional[GenerationStats] = None,
+) -> Tuple[int, str]:
+    """
+    Writes the build_pack archive layout into a binary file object (a file on
+    disk, a SpooledTemporaryFile, ...), so large packs are never held as bytes.
+    In-process rendering streams each file through a PackWriter.
+    Returns (chord_count, zip_name).
+    """
+    if workers <= 1 or len(progressions) <= 1:
+        writer = PackWriter(fileobj, revoice, seed, optimizer, stats)
+        try:
+            for item in progressions:
+                writer.add(item)
+        except BaseException:
+            writer.discard()
+            raise
+        return writer.close(), writer.zip_name
+
+    files, chord_count = _render_pack(progressions, revoice, seed, workers, pool, optimizer, stats)
+    t0 = time.perf_counter()
+    zip_rendered(files, fileobj)
+    if stats is not None:
+        stats.add_time("zip", t0)
+    return chord_count, _pack_zip_name(revoice)
+
+
+def build_pack_bytes(
+    progressions,
+    revoice: bool,
+    seed: int,
+    workers: int = RENDER_WORKERS,
+    pool: str = RENDER_POOL,
+    optimizer: str = VOICING_OPTIMIZER,
+    stats: Optional[GenerationStats] = None,
+) -> Tuple[bytes, int, str]:
+    """
+    Memory mode: write_pack into a buffer, for callers that want the bytes
+    (small packs). Returns (zip_bytes, chord_count, zip_name).
+    """
+    buf = io.BytesIO()
+    chord_count, zip_name = write_pack(buf, progressions, revoice, seed, workers, pool, optimizer, stats)
+    return buf.getvalue(), chord_count, zip_name
@@ -0,0 +1,68 @@
+# tests/test_banindex.py  BanIndex modes: hand-checked hits and misses; contains_many agrees with `in`
+# python -m pytest -q tests
+
+import random
+
+import pytest
+
+from aural_alchemy import engine
+
+BANNED = ["Cmaj-Gmaj-Amin-Fmaj", "Dmin7-Gsus4"]
+
+
+def _ids(text):
+    return engine.chord_ids(text.split("-"))
+
+
+@pytest.fixture(scope="module")
+def index():
+    return engine.BanIndex([_ids(p) for p in BANNED])
+
+
+# (mode, banned progression, allowed progression)
+CASES = [
+    ("exact", "Cmaj-Gmaj-Amin-Fmaj", "Gmaj-Amin-Fmaj-Cmaj"),           # a rotation is a different loop
+    ("rotation", "Amin-Fmaj-Cmaj-Gmaj", "Fmaj-Amin-Gmaj-Cmaj"),        # any start, same order
+    ("contains", "Emin-Dmin7-Gsus4-Cmaj", "Emin-Gsus4-Dmin7-Cmaj"),    # fragment inside the loop
+    ("contains", "Gsus4-Cmaj-Amin-Dmin7", "Dmin7-Cmaj-Gsus4-Amin"),    # ... and across the wrap
+    ("transposed", "Dmaj-Amaj-Bmin-Gmaj", "Dmaj-Amaj-Gmaj-Bmin"),      # same motion, another key
+]
+
+
+@pytest.mark.parametrize("mode, hit, miss", CASES)
+def test_mode_hit_and_miss(index, mode, hit, miss):
+    view = index.with_mode(mode)
+    assert _ids(hit) in view
+    assert _ids(miss) not in view
+    assert engine.progression_is_banned(hit.split("-"), view)
+    assert not engine.progression_is_banned(miss.split("-"), view)
+    assert list(view.contains_many([_ids(hit), _ids(miss)])) == [True, False]
+
+
+def test_stricter_modes_include_exact(index):
+    for mode in engine.BAN_MODES:
+        assert _ids("Cmaj-Gmaj-Amin-Fmaj") in index.with_mode(mode)
+
+
+def test_legacy_sets_convert(index):
+    legacy = engine._as_ban_index({("Cmaj", "Gmaj", "Amin", "Fmaj"), _ids("Dmin7-Gsus4")})
+    assert legacy.arrays()[0].tolist() == index.arrays()[0].tolist()
+    assert engine.progression_is_banned(["Cmaj", "Gmaj", "Amin", "Fmaj"], {("Cmaj", "Gmaj", "Amin", "Fmaj")})
+    with pytest.raises(TypeError):
+        engine._as_ban_index([("Cmaj",)])
+
+
+@pytest.mark.parametrize("mode", engine.BAN_MODES)
+def test_contains_many_matches_per_item(mode):
+    progs, _, _, _, _ = engine.generate_progressions(300, 21)
+    ids = [engine.chord_ids(chords) for chords, _, _ in progs]
+    rng = random.Random(21)
+    # ban whole loops, rotations and 2-chord fragments of some of them
+    entries = [p for p in rng.sample(ids, 40)]
+    entries += [p[1:] + p[:1] for p in rng.sample(ids, 20)]
+    entries += [p[:2] for p in rng.sample(ids, 20)]
+    view = engine.BanIndex(entries).with_mode(mode)
+
+    got = view.contains_many(ids)
+    assert got.tolist() == [p in view for p in ids]
+    assert got.any() and not got.all()
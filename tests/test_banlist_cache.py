@@ -0,0 +1,88 @@
+# tests/test_banlist_cache.py  SHA-256 keyed banlist cache: append-prefix parsing and the .npy/mmap disk tier match a cold parse
+# python -m pytest -q tests
+
+import os
+
+import numpy as np
+import pytest
+
+from aural_alchemy import engine
+
+
+def _lines(seed, n, bad):
+    progs = engine.generate_progressions(n, seed)[0]
+    lines = ["-".join(chords) for chords, _, _ in progs]
+    lines.insert(n // 2, bad)       # one unparseable line per chunk
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+A = _lines(1, 120, "C maj7 then G")
+B = _lines(2, 80, "Amin then F#")
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(engine, "BANLIST_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(engine, "_BANLIST_MEMORY", engine._BanlistMemory())
+    return tmp_path
+
+
+def _same_index(got, want):
+    for a, b in zip(got.arrays(), want.arrays()):
+        assert np.array_equal(np.asarray(a), np.asarray(b))
+    assert len(got) == len(want)
+
+
+def _same_counts(got, want):
+    for k in ("added", "invalid", "empty", "ignored_meta", "lines_with_chords", "lines"):
+        assert got[k] == want[k], k
+
+
+def test_append_matches_cold_parse(cache):
+    cold, cold_stats, cold_examples = engine.load_banlist_from_txt_bytes(A + B)
+
+    _, stats, _ = engine.load_banlist_cached(A)
+    assert stats["source"] == "parsed"
+    index, stats, examples = engine.load_banlist_cached(A + B)
+    assert stats["source"] == "append"
+
+    _same_index(index, cold)
+    _same_counts(stats, cold_stats)
+    assert examples == cold_examples
+    assert engine.load_banlist_cached(A + B)[1]["source"] == "memory"
+
+
+def test_disk_tier_is_memory_mapped(cache, monkeypatch):
+    cold, cold_stats, _ = engine.load_banlist_from_txt_bytes(A + B)
+    engine.load_banlist_cached(A)
+    engine.load_banlist_cached(A + B)
+    entries = [os.path.join(sub, key) for sub in os.listdir(cache) for key in os.listdir(cache / sub)]
+    assert len(entries) == 2
+    for entry in entries:
+        assert sorted(os.listdir(cache / entry)) == sorted(engine._BANLIST_ARRAY_FILES + ("meta.json",))
+
+    # a fresh process: nothing in memory, everything on disk
+    monkeypatch.setattr(engine, "_BANLIST_MEMORY", engine._BanlistMemory())
+    index, stats, _ = engine.load_banlist_cached(A + B)
+    assert stats["source"] == "disk"
+    assert all(isinstance(arr, np.memmap) for arr in index.arrays())
+    _same_index(index, cold)
+    _same_counts(stats, cold_stats)
+
+
+def test_append_from_a_prefix_on_disk(cache, monkeypatch):
+    cold = engine.load_banlist_from_txt_bytes(A + B)[0]
+    engine.load_banlist_cached(A)
+    monkeypatch.setattr(engine, "_BANLIST_MEMORY", engine._BanlistMemory())
+
+    index, stats, _ = engine.load_banlist_cached(A + B)
+    assert stats["source"] == "append"
+    _same_index(index, cold)
+
+
+def test_prefix_must_end_on_a_line_break(cache):
+    head = A[:-1]       # cut before the final newline: the next upload extends that line
+    engine.load_banlist_cached(head)
+    index, stats, _ = engine.load_banlist_cached(A + B)
+    assert stats["source"] == "parsed"
+    _same_index(index, engine.load_banlist_from_txt_bytes(A + B)[0])
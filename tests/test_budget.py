@@ -0,0 +1,76 @@
+# tests/test_budget.py  attempt budgets walk the relaxation ladder in order, deterministically
+# python -m pytest -q tests
+
+import pytest
+
+from aural_alchemy import engine
+
+SUS_TIGHT = dict({q: 0 for q in engine.ADV_ALL_QUALITIES}, sus2=100, sus4=100, maj=30, min=30)
+N = 100
+ATTEMPTS = 3000
+
+
+def _run(ladder, max_attempts=ATTEMPTS):
+    budget = engine.GenerationBudget(max_attempts=max_attempts, ladder=ladder)
+    return engine.generate_progressions(N, 3, SUS_TIGHT, budget=budget), budget
+
+
+def _over_default_sus_caps(progressions) -> bool:
+    for chords, _, _ in progressions:
+        sus = sum("sus" in ch for ch in chords)
+        sus4 = sum("sus4" in ch for ch in chords)
+        if sus / len(chords) > engine.DEFAULT_SUS_MAX_RATIO or sus4 > engine.DEFAULT_SUS4_MAX_COUNT:
+            return True
+    return False
+
+
+def test_each_rung_in_order():
+    # pattern_dupes only: repeats allowed, then a spent budget raises
+    budget = engine.GenerationBudget(max_attempts=ATTEMPTS, ladder=(engine.RELAX_PATTERN_DUPES,))
+    with pytest.raises(RuntimeError, match=r"Generation budget ran out \(attempts\)"):
+        engine.generate_progressions(N, 3, SUS_TIGHT, budget=budget)
+    assert budget.relaxed == [engine.RELAX_PATTERN_DUPES]
+    assert budget.attempts == ATTEMPTS
+    built_pattern_only = budget.built
+
+    # + fewer: the same run returns what it built
+    (out, dupes, max_dupes, _, _), budget = _run((engine.RELAX_PATTERN_DUPES, engine.RELAX_FEWER))
+    assert budget.relaxed == [engine.RELAX_PATTERN_DUPES, engine.RELAX_FEWER]
+    assert len(out) == budget.built == built_pattern_only
+    assert dupes > max_dupes
+    assert not _over_default_sus_caps(out)
+
+    # full ladder: sus caps loosened too, which builds more in the same budget
+    (out, dupes, max_dupes, low_sim, _), budget = _run(engine.RELAXATION_LADDER)
+    assert budget.relaxed == list(engine.RELAXATION_LADDER)
+    assert budget.exhausted == "attempts"
+    assert budget.attempts == ATTEMPTS
+    assert built_pattern_only < len(out) == budget.built < N
+    assert dupes > max_dupes
+    assert low_sim == 0
+    assert _over_default_sus_caps(out)
+    assert budget.summary() == (
+        f"Attempt budget ran out after {ATTEMPTS:,} attempts: allowed repeated progression shapes; "
+        f"loosened the sus-chord limits; returned {len(out)} of {N} progressions."
+    )
+
+
+def test_ladder_follows_the_given_order():
+    ladder = (engine.RELAX_SUS_SAFETY, engine.RELAX_PATTERN_DUPES, engine.RELAX_FEWER)
+    _, budget = _run(ladder)
+    assert budget.relaxed == list(ladder)
+
+
+def test_same_attempt_budget_same_result():
+    (first, *_), _ = _run(engine.RELAXATION_LADDER)
+    (again, *_), _ = _run(engine.RELAXATION_LADDER)
+    assert first == again
+
+
+@pytest.mark.parametrize("max_attempts", [0, 5])
+def test_nothing_built_within_budget(max_attempts):
+    budget = engine.GenerationBudget(max_attempts=max_attempts)
+    with pytest.raises(RuntimeError, match=r"^No progressions could be built within the generation budget\.$"):
+        engine.generate_progressions(N, 3, SUS_TIGHT, budget=budget)
+    assert budget.attempts == max_attempts
+    assert budget.relaxed[-1] == engine.RELAX_FEWER
@@ -0,0 +1,45 @@
+# tests/test_exact.py  the exact sampler fails fast when a balance cannot fit, and fills it when it can
+# python -m pytest -q tests
+
+import pytest
+
+from aural_alchemy import engine
+
+TRIADS_SUS = dict({q: 0 for q in engine.ADV_ALL_QUALITIES}, maj=100, min=100, sus2=100, sus4=100)
+MIN_ONLY = dict({q: 0 for q in engine.ADV_ALL_QUALITIES}, min=100)
+
+
+def _size(balance):
+    return engine.get_generation_plan(balance).exact_space()["size"]
+
+
+@pytest.mark.parametrize("n", [20, 200])
+def test_impossible_balance_fails_fast(n):
+    size = _size(TRIADS_SUS)
+    allowed = n // 100      # floor(n * MAX_PATTERN_DUPLICATE_RATIO)
+    assert n > size + allowed
+
+    stats = engine.GenerationStats()
+    with pytest.raises(RuntimeError) as err:
+        engine.generate_progressions(n, 3, TRIADS_SUS, sampler="exact", stats=stats)
+    assert str(err.value) == (
+        f"The exact sampler only has {size} distinct progression shapes for the current "
+        f"chord-type balance (+{allowed} allowed repeats); {n} were requested. "
+        "It only uses the enabled chord types; the default sampler can substitute "
+        "others to avoid repeated chords and may fit more."
+    )
+    assert stats.as_dict()["attempts"] == 0
+
+
+def test_empty_space_fails_fast():
+    assert _size(MIN_ONLY) == 0
+    with pytest.raises(RuntimeError, match=r"^No legal progressions exist for the current chord-type balance\.$"):
+        engine.generate_progressions(10, 3, MIN_ONLY, sampler="exact")
+
+
+@pytest.mark.parametrize("balance, n", [(TRIADS_SUS, None), (None, 50)], ids=["at_capacity", "default"])
+def test_feasible_balance_generates(balance, n):
+    n = n or _size(balance)
+    out = engine.generate_progressions(n, 3, balance, sampler="exact")[0]
+    assert len(out) == n
+    assert len({tuple(chords) for chords, _, _ in out}) == n
@@ -0,0 +1,65 @@
+# tests/test_parallel.py  per-progression seed streams: output and stats must not depend on the worker count
+# python -m pytest -q tests
+
+import threading
+
+import pytest
+
+from aural_alchemy import engine
+
+SUS_HEAVY = dict({q: 50 for q in engine.ADV_ALL_QUALITIES}, sus2=100, sus4=100, sus2add9=100, sus4add9=100)
+
+
+def _run(n, seed, balance, workers):
+    stats = engine.GenerationStats()
+    progs = engine.generate_progressions(n, seed, balance, workers=workers, stats=stats)
+    return progs, stats.as_dict()
+
+
+def _counts(report):
+    return report["attempts"], report["accepted"], report["rejections"]
+
+
+def test_output_and_stats_match_for_any_worker_count():
+    n = max(engine.PARALLEL_MIN_N, 1500)
+    (progs1, stats1) = _run(n, 5, None, 1)
+    for workers in (2, 4):
+        progs, stats = _run(n, 5, None, workers)
+        assert progs == progs1
+        assert _counts(stats) == _counts(stats1)
+
+
+@pytest.mark.parametrize("balance", [None, SUS_HEAVY], ids=["default", "sus_heavy"])
+def test_fork_path_is_reproducible(monkeypatch, balance):
+    monkeypatch.setattr(engine, "PARALLEL_MIN_N", 50)
+    (progs1, stats1) = _run(400, 11, balance, 1)
+    for workers in (2, 4, 8):
+        progs, stats = _run(400, 11, balance, workers)
+        assert progs == progs1
+        assert _counts(stats) == _counts(stats1)
+
+
+def test_shards_in_process_match_per_index_path(monkeypatch):
+    monkeypatch.setattr(engine, "PARALLEL_MIN_N", 50)
+    forked = _run(400, 3, SUS_HEAVY, 2)
+
+    # shard + merge path, with the shards run in-process
+    with monkeypatch.context() as m:
+        m.setattr(engine, "_run_jobs", lambda fn, jobs, workers, kind="process": [fn(job) for job in jobs])
+        shards = _run(400, 3, SUS_HEAVY, 2)
+
+    # fork not allowed: the per-index streams are drawn in-process
+    with monkeypatch.context() as m:
+        m.setattr(engine, "_fork_allowed", lambda: False)
+        per_index = _run(400, 3, SUS_HEAVY, 2)
+
+    assert shards[0] == per_index[0] == forked[0]
+    assert _counts(shards[1]) == _counts(per_index[1]) == _counts(forked[1])
+
+
+def test_no_fork_off_the_main_thread():
+    seen = []
+    t = threading.Thread(target=lambda: seen.append(engine._fork_allowed()))
+    t.start()
+    t.join()
+    assert seen == [False]
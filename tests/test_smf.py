@@ -0,0 +1,71 @@
+# tests/test_smf.py  the direct SMF encoder must match the pretty_midi exporter it replaced
+# python -m pytest -q tests
+
+import io
+
+import pytest
+
+from aural_alchemy import engine
+
+pretty_midi = pytest.importorskip("pretty_midi")
+
+TIME_TOL_S = 1e-3   # the two writers use different tick resolutions
+
+
+def _blocks(chords, durations):
+    """Same block construction as render_progression_midi (raw voicing)."""
+    notes = engine.optimize_progression_register([engine.raw_chord_notes(ch) for ch in chords])
+    return [(sorted({int(p + engine.GLOBAL_TRANSPOSE) for p in ns}), bars) for ns, bars in zip(notes, durations)]
+
+
+def _read(data: bytes):
+    return pretty_midi.PrettyMIDI(io.BytesIO(data))
+
+
+def _notes(midi):
+    assert len(midi.instruments) == 1
+    return sorted(
+        ((n.start, n.pitch, n.velocity, n.end) for n in midi.instruments[0].notes),
+        key=lambda n: (round(n[0], 3), n[1]),
+    )
+
+
+HAND_BLOCKS = [
+    [([60, 64, 67], 1)],
+    [([48, 55, 64, 71], 2), ([50, 57, 65, 72], 2)],
+    # a pitch held across blocks: note off and note on land on the same tick
+    [([57, 60, 64], 1), ([57, 62, 65], 1), ([55, 59, 62, 65], 2), ([60, 64, 67], 4)],
+]
+
+
+def _generated_blocks():
+    progs, *_ = engine.generate_progressions(6, 2024)
+    return [_blocks(chords, durs) for chords, durs, _key in progs]
+
+
+@pytest.mark.parametrize("blocks", HAND_BLOCKS + _generated_blocks())
+def test_direct_smf_matches_pretty_midi(blocks):
+    direct = _read(engine.encode_block_chord_smf(blocks))
+    ref = _read(engine._pretty_midi_bytes(blocks))
+
+    got, want = _notes(direct), _notes(ref)
+    assert len(got) == len(want) == sum(len(p) for p, _ in blocks)
+    for (g_start, g_pitch, g_vel, g_end), (w_start, w_pitch, w_vel, w_end) in zip(got, want):
+        assert g_pitch == w_pitch
+        assert g_vel == w_vel == engine.VELOCITY
+        assert g_start == pytest.approx(w_start, abs=TIME_TOL_S)
+        assert g_end == pytest.approx(w_end, abs=TIME_TOL_S)
+
+    assert direct.instruments[0].program == ref.instruments[0].program == 0
+
+    _, d_tempi = direct.get_tempo_changes()
+    _, r_tempi = ref.get_tempo_changes()
+    assert list(d_tempi) == pytest.approx(list(r_tempi), abs=1e-3)
+    assert d_tempi[0] == pytest.approx(engine.BPM, abs=1e-3)
+
+    d_ts = [(t.numerator, t.denominator, t.time) for t in direct.time_signature_changes]
+    r_ts = [(t.numerator, t.denominator, t.time) for t in ref.time_signature_changes]
+    assert d_ts == r_ts == [(engine.TIME_SIG[0], engine.TIME_SIG[1], 0.0)]
+
+    total_s = sum(bars for _, bars in blocks) * engine.SEC_PER_BAR
+    assert direct.get_end_time() == pytest.approx(total_s, abs=TIME_TOL_S)
@@ -0,0 +1,52 @@
+# tests/test_stream.py  iter_progressions must match generate_progressions; the budget clock pauses between items
+# python -m pytest -q tests
+
+import time
+
+import pytest
+
+from aural_alchemy import engine
+
+SUS_HEAVY = dict({q: 50 for q in engine.ADV_ALL_QUALITIES}, sus2=100, sus4=100, sus2add9=100, sus4add9=100)
+
+
+def _banlist(progressions):
+    text = "\n".join("-".join(chords) for chords, _, _ in progressions).encode("utf-8")
+    index, _, invalid = engine.load_banlist_from_txt_bytes(text)
+    assert not invalid
+    return index
+
+
+@pytest.mark.parametrize("balance", [None, SUS_HEAVY], ids=["default", "sus_heavy"])
+@pytest.mark.parametrize("workers", [0, 2])
+@pytest.mark.parametrize("banned", [False, True], ids=["no_bans", "bans"])
+def test_stream_matches_generate(balance, workers, banned):
+    ban_set = None
+    if banned:
+        first = engine.generate_progressions(40, 8, balance, workers=workers)[0]
+        ban_set = _banlist(first[:6])
+
+    stream = engine.iter_progressions(40, 8, balance, ban_set=ban_set, workers=workers)
+    streamed = list(stream)
+    out, dupes, max_dupes, low_sim, usage = engine.generate_progressions(40, 8, balance, ban_set=ban_set, workers=workers)
+
+    assert streamed == out
+    assert (stream.pattern_dupe_used, stream.max_pattern_dupes, stream.low_sim_total) == (dupes, max_dupes, low_sim)
+    assert stream.qual_usage == usage
+    if banned:
+        assert not any(p in out for p in first[:6])
+
+
+def test_consumer_time_is_not_charged_to_the_deadline():
+    budget = engine.GenerationBudget(deadline_s=0.25)
+    stream = engine.iter_progressions(20, 3, budget=budget)
+    time.sleep(0.3)     # before the first item
+    got = []
+    for item in stream:
+        got.append(item)
+        time.sleep(0.03)    # "rendering": 0.6 s in total, well past the deadline
+
+    assert len(got) == 20
+    assert budget.exhausted is None
+    assert budget.relaxed == []
+    assert budget.elapsed_ms < 250.0
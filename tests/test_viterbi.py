@@ -0,0 +1,41 @@
+# tests/test_viterbi.py  _viterbi_path must find the brute-force optimum (open chain and loop closure)
+# python -m pytest -q tests
+
+import itertools
+
+import numpy as np
+import pytest
+
+from aural_alchemy import engine
+
+
+def _cost(path, static, trans, closure):
+    total = sum(static[i][j] for i, j in enumerate(path))
+    total += sum(trans[i][path[i], path[i + 1]] for i in range(len(path) - 1))
+    if closure is not None:
+        total += closure[path[-1], path[0]]
+    return total
+
+
+def _problem(seed, n):
+    rng = np.random.default_rng(seed)
+    ks = [int(k) for k in rng.integers(1, 5, size=n)]    # k <= 4 candidates per chord
+    static = [rng.uniform(0, 100, size=k) for k in ks]
+    trans = [rng.uniform(0, 100, size=(ks[i], ks[i + 1])) for i in range(n - 1)]
+    closure = rng.uniform(0, 100, size=(ks[-1], ks[0]))
+    return ks, static, trans, closure
+
+
+@pytest.mark.parametrize("loop", [False, True], ids=["open", "closure"])
+@pytest.mark.parametrize("n", [1, 2, 3, 4, 5])
+def test_viterbi_matches_brute_force(n, loop):
+    for seed in range(25):
+        ks, static, trans, closure = _problem(seed * 10 + n, n)
+        closure = closure if loop and n >= 2 else None
+
+        path = engine._viterbi_path(static, trans, closure)
+        assert len(path) == n
+        assert all(0 <= j < k for j, k in zip(path, ks))
+
+        best = min(itertools.product(*(range(k) for k in ks)), key=lambda p: _cost(p, static, trans, closure))
+        assert _cost(path, static, trans, closure) == pytest.approx(_cost(best, static, trans, closure))
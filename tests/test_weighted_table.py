@@ -0,0 +1,53 @@
+# tests/test_weighted_table.py  WeightedTable.draw must consume the RNG exactly like rng.choices
+# python -m pytest -q tests
+
+import random
+
+import pytest
+
+from aural_alchemy import engine
+
+TABLES = {
+    "ints": [("a", 5), ("b", 1), ("c", 3)],
+    "floats": [("a", 0.4), ("b", 0.35), ("c", 0.2), ("d", 0.05)],
+    "zeros": [("a", 0), ("b", 2), ("c", 0), ("d", 1), ("e", 0)],
+    "single": [("a", 7)],
+}
+
+
+def _weights(table):
+    # back out the per-item weights from the prefix sums
+    return [c - p for p, c in zip([0] + table.cum[:-1], table.cum)]
+
+
+def _assert_same_draws(pairs, seed, draws=5000):
+    table = engine.WeightedTable(pairs)
+    items = [x for x, _ in pairs]
+    weights = [w for _, w in pairs]
+    ours, ref = random.Random(seed), random.Random(seed)
+
+    got = [table.draw(ours) for _ in range(draws)]
+    want = [ref.choices(items, weights=weights, k=1)[0] for _ in range(draws)]
+    assert got == want
+    assert ours.getstate() == ref.getstate()
+
+
+@pytest.mark.parametrize("seed", [0, 7, 12345])
+@pytest.mark.parametrize("name", sorted(TABLES))
+def test_draws_match_rng_choices(name, seed):
+    _assert_same_draws(TABLES[name], seed)
+
+
+def test_generation_tables_match_rng_choices():
+    plan = engine.get_generation_plan(None)
+    tables = [plan.combos, *plan.templates.values(), *plan.durations.values()]
+    tables += [t for pools in plan.deg_pools.values() for t in pools.values() if len(t)]
+    for seed, table in enumerate(tables):
+        _assert_same_draws(list(zip(table.items, _weights(table))), seed, draws=500)
+
+
+def test_empty_table_draws_nothing():
+    rng = random.Random(1)
+    state = rng.getstate()
+    assert engine.WeightedTable([]).draw(rng) is None
+    assert rng.getstate() == state